@@ -1,24 +1,14 @@
-# Generates users with random username/password and exports to CSV
-import csv
-import uuid
-import sys
-from core.models import User, Profile
-from amt.generate_usernames import generate_usernames
+# Generates users with random username/password and exports to CSV.
+# Usage: python amt.py <number of users>; see `manage.py provision_turkers --help`
+# for the options.
 import os
+import sys
+
 import django
+from django.core.management import call_command
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'trick.settings')
 django.setup()
 
 
-with open('users.csv', 'w') as f:
-    writer = csv.writer(f, quoting=csv.QUOTE_ALL)
-    writer.writerow(['username', 'password'])
-
-    os.chdir('./amt')
-    for username in generate_usernames(int(sys.argv[1])):
-        password = uuid.uuid4().hex
-        user = User.objects.create_user(
-            username=username, password=password, email=None)
-        profile = Profile.objects.create(
-            user=user, is_turker=True, source="amt")
-        writer.writerow([username, password])
+call_command('provision_turkers', int(sys.argv[1]), output='users.csv')
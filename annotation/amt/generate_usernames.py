@@ -44,14 +44,11 @@ def generate_usernames(num_users):
 
     usernames = []
     for i in range(num_users):
-      if i > len(adjectives):
-        i -= len(adjectives)
-        random.shuffle(adjectives)
-      if i > len(animals):
-        i -= len(animals)
-        random.shuffle(animals)
-
-      usernames.append('{}_{}'.format(adjectives[i], animals[i]).replace(' ', '_').lower())
+      # Walk both lists in step, wrapping around each one separately: a pair
+      # only repeats after lcm(len(adjectives), len(animals)) usernames.
+      adjective = adjectives[i % len(adjectives)]
+      animal = animals[i % len(animals)]
+      usernames.append('{}_{}'.format(adjective, animal).replace(' ', '_').lower())
 
     return usernames
 
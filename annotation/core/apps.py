@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class CoreConfig(AppConfig):
+    name = 'core'
+
+    def ready(self):
+        if settings.ANNOTATION_WRITE_BEHIND:
+            # Replays entries a crashed worker left in the journal without
+            # waiting for this worker's first submission.
+            from core import journal
+            journal.start_flusher()
@@ -0,0 +1,168 @@
+"""Chooses which Generation an annotator should see next.
+
+Candidates are ranked into tiers by how many annotations they already have
+(the denormalized `Generation.num_annotations` counter, see core.counters)
+plus how many unexpired leases other annotators hold on them. Examples are
+taken from the best non-empty tier, starting at a random primary key and
+walking the primary key index from there, so a pick stops at the first
+matching rows instead of sorting the whole playlist. The cost depends
+on neither the size of Annotation nor that of the playlist.
+
+Serving a generation records a Lease so that concurrent annotators (possibly
+in different worker processes) are not all handed the same under-annotated
+example. Leases live in the database, are released by `release()` when the
+annotation is saved, and stop counting once they expire. Anonymous visitors
+(`user` is None) are served examples without leasing them.
+"""
+import random
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import (
+    Case, Count, Exists, F, IntegerField, Max, Min, OuterRef, Subquery, Value, When)
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from core.models import Annotation, Generation, Lease
+
+
+# The desired number of annotations per example. Each example will be
+# assigned to this many users before any new annotation gets assigned.
+GOAL_NUM_ANNOTATIONS = 4
+# How long a served example stays reserved for its annotator.
+LEASE_DURATION = timedelta(minutes=10)
+# How many candidates to try before giving up on finding one whose leases
+# do not already cover the goal.
+_MAX_ATTEMPTS = 3
+
+# Examples that have been started but whose annotations and outstanding leases
+# have not yet reached the goal.
+_TIER_IN_PROGRESS = 0
+# Examples without annotations that nobody else holds a lease on.
+_TIER_FRESH = 1
+# Examples whose annotations and outstanding leases already cover the goal.
+_TIER_COVERED = 2
+
+
+def _active_leases(user, now):
+    """Expression counting the unexpired leases other users hold on the outer Generation."""
+    leases = Lease.objects.filter(generation=OuterRef('pk'), expires__gt=now)
+    if user is not None:
+        leases = leases.exclude(annotator=user)
+    leases = leases.order_by()
+    leases = leases.values('generation').annotate(count=Count('pk')).values('count')
+    return Coalesce(Subquery(leases, output_field=IntegerField()), Value(0))
+
+
+def _ranked(user, playlist_id):
+    """Returns the generations `user` has not annotated, annotated with their tier."""
+    generations = Generation.objects.all()
+    if playlist_id is not None and playlist_id >= 0:
+        generations = generations.filter(playlist__id=playlist_id)
+
+    if user is not None:
+        seen = Annotation.objects.filter(annotator=user, generation=OuterRef('pk'))
+        generations = generations.filter(~Exists(seen))
+    generations = generations.annotate(num_leases=_active_leases(user, timezone.now()))
+    generations = generations.annotate(coverage=F('num_annotations') + F('num_leases'))
+    return generations.annotate(tier=Case(
+        When(coverage__gte=1,
+             coverage__lt=GOAL_NUM_ANNOTATIONS,
+             then=Value(_TIER_IN_PROGRESS)),
+        When(coverage=0, then=Value(_TIER_FRESH)),
+        default=Value(_TIER_COVERED),
+        output_field=IntegerField()))
+
+
+def candidates(user, playlist_id=None, count=1, exclude=()):
+    """Returns up to `count` generations `user` has not annotated, best candidates first.
+
+    Examples with at least one but fewer than GOAL_NUM_ANNOTATIONS annotations
+    (counting outstanding leases) come first, followed by the unseen examples nobody
+    else holds, and finally those whose annotations and leases already cover
+    the goal. Within a tier, examples are taken in primary key order from a
+    random starting point, wrapping around. Generations in `exclude` are skipped.
+    """
+    generations = _ranked(user, playlist_id).exclude(pk__in=exclude)
+    bounds = Generation.objects.aggregate(low=Min('pk'), high=Max('pk'))
+    if bounds['low'] is None:
+        return []
+
+    chosen = []
+    for tier in (_TIER_IN_PROGRESS, _TIER_FRESH, _TIER_COVERED):
+        in_tier = generations.filter(tier=tier).order_by('pk')
+        start = random.randint(bounds['low'], bounds['high'])
+        chosen += in_tier.filter(pk__gte=start)[:count - len(chosen)]
+        if len(chosen) < count:
+            chosen += in_tier.filter(pk__lt=start)[:count - len(chosen)]
+        if len(chosen) == count:
+            break
+    return chosen
+
+
+def acquire_lease(user, generation):
+    """Reserves `generation` for `user` for LEASE_DURATION, refreshing any
+    existing lease, and returns the Lease."""
+    expires = timezone.now() + LEASE_DURATION
+    updated = Lease.objects.filter(annotator=user, generation=generation).update(expires=expires)
+    if updated:
+        return Lease.objects.get(annotator=user, generation=generation)
+    try:
+        with transaction.atomic():
+            return Lease.objects.create(annotator=user, generation=generation, expires=expires)
+    except IntegrityError:
+        # A concurrent request from the same user created it first.
+        return Lease.objects.get(annotator=user, generation=generation)
+
+
+def _within_goal(lease, generation):
+    """Returns whether `lease` still fits under the goal now that it is
+    recorded. Leases are ranked by id, so when several workers lease the same
+    example at once the earliest ones win and the rest back off."""
+    earlier = Lease.objects.filter(
+        generation=generation, expires__gt=timezone.now(), id__lt=lease.id).count()
+    num_annotations = Generation.objects.values_list(
+        'num_annotations', flat=True).get(pk=generation.pk)
+    return num_annotations + earlier + 1 <= GOAL_NUM_ANNOTATIONS
+
+
+def next_generations(user, playlist_id=None, count=1, exclude=()):
+    """Returns up to `count` Generations `user` should annotate next, leasing
+    each of them to the user. Generations in `exclude` are skipped."""
+    if user is None:
+        return candidates(None, playlist_id, count, exclude)
+
+    chosen, excluded = [], list(exclude)
+    for attempt in range(_MAX_ATTEMPTS):
+        wanted = count - len(chosen)
+        batch = candidates(user, playlist_id, wanted, excluded)
+        last_attempt = attempt == _MAX_ATTEMPTS - 1
+        for generation in batch:
+            excluded.append(generation.pk)
+            lease = acquire_lease(user, generation)
+            if generation.tier != _TIER_IN_PROGRESS or last_attempt or _within_goal(lease, generation):
+                chosen.append(generation)
+            else:
+                # Another worker leased this example at the same time; try another one.
+                lease.delete()
+        if len(chosen) == count or len(batch) < wanted:
+            break
+    return chosen
+
+
+def next_generation(user, playlist_id=None):
+    """Returns the next Generation `user` should annotate and leases it to
+    them, or returns None if there is nothing left for them in the playlist."""
+    generations = next_generations(user, playlist_id)
+    return generations[0] if generations else None
+
+
+def release(user_id, generation_ids):
+    """Releases the leases `user_id` holds on the given generations."""
+    Lease.objects.filter(annotator_id=user_id, generation_id__in=generation_ids).delete()
+
+
+def purge_expired_leases():
+    """Deletes expired leases and returns how many were removed."""
+    deleted, _ = Lease.objects.filter(expires__lte=timezone.now()).delete()
+    return deleted
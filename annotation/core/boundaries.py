@@ -0,0 +1,74 @@
+"""Stored boundaries and correctness.
+
+`Generation.boundary` holds the index of the last human-written sentence,
+copied from `Prompt.num_sentences - 1` when the generation is created.
+`Annotation.distance` and `Annotation.is_correct` compare an annotation's
+guess with it and are written when the annotation is saved. Accuracy
+statistics can then aggregate Annotation alone instead of joining Generation
+and Prompt for every row.
+
+Rows created before these columns existed are filled in by `backfill()`
+(`manage.py backfill_boundaries`).
+"""
+from django.db import transaction
+from django.db.models import BooleanField, Case, F, Max, OuterRef, Subquery, Value, When
+
+from core.models import Annotation, Generation, Prompt
+
+
+def true_boundary(num_sentences):
+    """Returns the boundary of a generation whose prompt has `num_sentences` sentences."""
+    return num_sentences - 1
+
+
+def score(guess, boundary):
+    """Returns the `distance` and `is_correct` fields of an annotation guessing
+    `guess` on a generation whose boundary is `boundary`."""
+    return {'distance': guess - boundary, 'is_correct': guess == boundary}
+
+
+def of(generation_ids):
+    """Returns the boundaries of the given generations, keyed by id."""
+    boundaries = dict(Generation.objects.filter(
+        pk__in=generation_ids).values_list('pk', 'boundary'))
+    missing = [pk for pk, boundary in boundaries.items() if boundary is None]
+    if missing:
+        # Not backfilled yet.
+        boundaries.update({
+            pk: true_boundary(num_sentences) for pk, num_sentences in Generation.objects.filter(
+                pk__in=missing).values_list('pk', 'prompt__num_sentences')})
+    return boundaries
+
+
+def _ranges(model, batch_size):
+    last_pk = model.objects.aggregate(last=Max('pk'))['last'] or 0
+    for start in range(0, last_pk + 1, batch_size):
+        yield model.objects.filter(pk__gte=start, pk__lt=start + batch_size)
+
+
+def backfill(batch_size=5000, force=False):
+    """Fills in `Generation.boundary`, then `Annotation.distance` and
+    `Annotation.is_correct`, for rows that do not have them yet (or for every
+    row with `force`), one primary key range per transaction. Returns the
+    number of generations and annotations updated."""
+    num_sentences = Prompt.objects.filter(pk=OuterRef('prompt_id')).values('num_sentences')[:1]
+    generations = 0
+    for batch in _ranges(Generation, batch_size):
+        if not force:
+            batch = batch.filter(boundary__isnull=True)
+        with transaction.atomic():
+            generations += batch.update(boundary=Subquery(num_sentences) - 1)
+
+    boundary = Generation.objects.filter(pk=OuterRef('generation_id')).values('boundary')[:1]
+    annotations = 0
+    for batch in _ranges(Annotation, batch_size):
+        if not force:
+            batch = batch.filter(is_correct__isnull=True)
+        with transaction.atomic():
+            annotations += batch.update(distance=F('boundary') - Subquery(boundary))
+            batch.update(is_correct=Case(
+                When(distance=0, then=Value(True)),
+                When(distance__isnull=True, then=Value(None)),
+                default=Value(False),
+                output_field=BooleanField()))
+    return generations, annotations
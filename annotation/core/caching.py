@@ -0,0 +1,137 @@
+"""Cached aggregates shared by every worker process.
+
+The default cache is a FileBasedCache (see `CACHES` in settings), so a value
+computed by one gunicorn worker is served by all of them. On top of it,
+`get()` adds:
+
+* a TTL after which a value is stale but still kept, for STALE_TTL more
+  seconds, to serve while it is being recomputed;
+* explicit invalidation: `invalidate()` changes a key's version, which makes
+  the stored value stale immediately. A recomputation that raced with the
+  invalidation is stored under the old version and is stale as well;
+* single-flight recomputation: only the worker holding a key's lock file
+  recomputes it. Other workers serve the stale value, or, when there is none
+  yet, wait up to WAIT_TIMEOUT for the lock holder before computing it
+  themselves.
+
+Lock files are created with O_EXCL in the cache directory, and abandoned
+ones are claimed by renaming them, both of which are atomic across processes
+on a local filesystem.
+"""
+import hashlib
+import os
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+# Seconds a stale value is kept around to be served while it is recomputed.
+STALE_TTL = 60 * 60
+# Seconds after which a lock file is considered abandoned by a crashed worker.
+LOCK_TIMEOUT = 30
+# Seconds to wait for another worker to compute a value nobody has yet.
+WAIT_TIMEOUT = 5
+_WAIT_INTERVAL = 0.05
+
+
+def _version_key(key):
+    return key + ':version'
+
+
+def _lock_path(key):
+    return os.path.join(settings.CACHE_PATH, hashlib.md5(key.encode()).hexdigest() + '.lock')
+
+
+def _break_stale_lock(path):
+    """Removes the lock file at `path` if it is older than LOCK_TIMEOUT, and
+    returns whether the lock may be taken now. The lock is claimed by renaming
+    it to a name of our own, which only one worker can do. If the claimed file
+    turns out to be a fresh lock that another worker created after the age
+    check, it is linked back in place."""
+    claimed = '{}.{}'.format(path, uuid.uuid4().hex)
+    try:
+        if time.time() - os.path.getmtime(path) < LOCK_TIMEOUT:
+            return False
+        os.rename(path, claimed)
+    except FileNotFoundError:
+        # Released, or claimed by another worker, in the meantime.
+        return True
+    try:
+        if time.time() - os.path.getmtime(claimed) < LOCK_TIMEOUT:
+            try:
+                os.link(claimed, path)
+            except FileExistsError:
+                pass
+            return False
+        return True
+    finally:
+        os.remove(claimed)
+
+
+def _acquire(key):
+    path = _lock_path(key)
+    for _ in range(2):
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileNotFoundError:
+            os.makedirs(settings.CACHE_PATH, exist_ok=True)
+        except FileExistsError:
+            if not _break_stale_lock(path):
+                return False
+    return False
+
+
+def _release(key):
+    try:
+        os.remove(_lock_path(key))
+    except FileNotFoundError:
+        pass
+
+
+def _compute(key, compute, ttl, version):
+    value = compute()
+    cache.set(key, (value, time.time() + ttl, version), ttl + STALE_TTL)
+    return value
+
+
+def get(key, compute, ttl):
+    """Returns the cached value of `key`, calling `compute()` to refresh it
+    when it is missing, older than `ttl` seconds or invalidated."""
+    stored = cache.get_many([key, _version_key(key)])
+    entry, version = stored.get(key), stored.get(_version_key(key))
+    if entry is not None:
+        value, fresh_until, entry_version = entry
+        if entry_version == version and time.time() < fresh_until:
+            return value
+
+    deadline = time.time() + WAIT_TIMEOUT
+    while not _acquire(key):
+        if entry is not None:
+            # Someone else is refreshing it.
+            return entry[0]
+        if time.time() >= deadline:
+            return compute()
+        time.sleep(_WAIT_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None and entry[2] == version:
+            return entry[0]
+    try:
+        return _compute(key, compute, ttl, version)
+    finally:
+        _release(key)
+
+
+def peek(key):
+    """Returns the value stored for `key`, fresh or stale, without computing
+    it, or None if there is none."""
+    entry = cache.get(key)
+    return entry[0] if entry is not None else None
+
+
+def invalidate(*keys):
+    """Marks the values of `keys` as stale. They are still served to other
+    workers while the first reader recomputes them."""
+    cache.set_many({_version_key(key): uuid.uuid4().hex for key in keys}, None)
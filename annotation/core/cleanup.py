@@ -0,0 +1,90 @@
+"""Batched removal of abandoned temporary users and expired sessions.
+
+A temporary user is abandoned when it has no annotations and has not logged
+in for a while. Deleting them (and expired sessions) in one statement would
+hold locks on auth_user, core_profile and django_session for as long as it
+runs, so both are deleted in small batches, each in its own short
+transaction. Batches walk the tables in primary key order, so every batch
+resumes where the previous one stopped instead of rescanning.
+"""
+import csv
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from core.models import Annotation, LeaderboardEntry, Lease, Profile
+
+
+def _abandoned(cutoff):
+    annotations = Annotation.objects.filter(annotator=OuterRef('user_id'))
+    return Profile.objects.filter(
+        Q(user__last_login__lt=cutoff) |
+        Q(user__last_login__isnull=True, user__date_joined__lt=cutoff),
+        is_temporary=True,
+    ).filter(~Exists(annotations))
+
+
+def purge_temporary_users(idle_days=30, batch_size=500, pause=0.0, archive=None):
+    """Deletes temporary users without annotations that have been idle for
+    `idle_days`, `batch_size` at a time, sleeping `pause` seconds between
+    batches. Yields the number of users deleted by each batch. If `archive`
+    is a path, the id, username and dates of every deleted user are appended
+    to it as CSV once their batch has committed."""
+    cutoff = timezone.now() - timedelta(days=idle_days)
+    last_id = 0
+    while True:
+        try:
+            with transaction.atomic():
+                user_ids = list(_abandoned(cutoff).filter(user_id__gt=last_id).order_by(
+                    'user_id').values_list('user_id', flat=True)[:batch_size])
+                if not user_ids:
+                    return
+                last_id = user_ids[-1]
+
+                # Lock the users before checking again, so a user who
+                # annotated since the batch was picked is kept, and one who
+                # annotates from now on waits for the delete to commit.
+                list(User.objects.select_for_update().filter(
+                    pk__in=user_ids).values_list('pk', flat=True))
+                user_ids = list(_abandoned(cutoff).filter(
+                    user_id__in=user_ids).values_list('user_id', flat=True))
+                users = list(User.objects.filter(pk__in=user_ids).values_list(
+                    'pk', 'username', 'date_joined', 'last_login')) if archive else []
+
+                # Relations to User are DO_NOTHING, so dependent rows go first.
+                Lease.objects.filter(annotator_id__in=user_ids).delete()
+                LeaderboardEntry.objects.filter(user_id__in=user_ids).delete()
+                Profile.objects.filter(user_id__in=user_ids).delete()
+                User.objects.filter(pk__in=user_ids).delete()
+        except IntegrityError:
+            # Rows referencing one of the users were added anyway (databases
+            # without row locks, such as SQLite, do not honor
+            # select_for_update). The batch is rolled back and left for the
+            # next run.
+            yield 0
+            continue
+
+        if archive:
+            with open(archive, 'a', newline='') as archive_file:
+                csv.writer(archive_file).writerows(users)
+        yield len(user_ids)
+        time.sleep(pause)
+
+
+def purge_expired_sessions(batch_size=1000, pause=0.0):
+    """Deletes expired sessions `batch_size` at a time, sleeping `pause`
+    seconds between batches. Yields the number deleted by each batch."""
+    now = timezone.now()
+    while True:
+        keys = list(Session.objects.filter(expire_date__lt=now).order_by(
+            'session_key').values_list('session_key', flat=True)[:batch_size])
+        if not keys:
+            return
+        Session.objects.filter(session_key__in=keys).delete()
+        yield len(keys)
+        time.sleep(pause)
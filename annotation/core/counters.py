@@ -0,0 +1,71 @@
+"""Maintains the denormalized annotation counters.
+
+`Generation.num_annotations` holds the number of annotations per generation and
+`AnnotationCount` holds the number per generation/playlist pair. Both are
+updated with relative `F()` increments so concurrent saves never lose a count.
+"""
+import functools
+import operator
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Case, Count, F, IntegerField, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce
+
+from core.models import Annotation, AnnotationCount, Generation
+
+
+def _increment_pairs(pair_counts):
+    """Adds `pair_counts`, amounts keyed by (generation_id, playlist), to the
+    AnnotationCount rows with two statements however many pairs there are."""
+    if not pair_counts:
+        return
+    pairs = sorted(pair_counts)
+    # Rows that already exist, or that another request creates first, are kept.
+    AnnotationCount.objects.bulk_create([
+        AnnotationCount(generation_id=generation_id, playlist=playlist, count=0)
+        for generation_id, playlist in pairs], ignore_conflicts=True)
+    AnnotationCount.objects.filter(functools.reduce(operator.or_, (
+        Q(generation_id=generation_id, playlist=playlist) for generation_id, playlist in pairs
+    ))).update(count=F('count') + Case(*(
+        When(generation_id=generation_id, playlist=playlist, then=Value(amount))
+        for (generation_id, playlist), amount in sorted(pair_counts.items())
+    ), output_field=IntegerField()))
+
+
+def add_annotations(pairs):
+    """Counts new annotations, given as (generation_id, playlist) pairs.
+
+    Should be called inside the transaction that creates the annotations.
+    """
+    pair_counts = Counter((int(generation_id), str(playlist)) for generation_id, playlist in pairs)
+    generation_counts = Counter()
+    for (generation_id, _), amount in pair_counts.items():
+        generation_counts[generation_id] += amount
+
+    for generation_id, amount in sorted(generation_counts.items()):
+        Generation.objects.filter(pk=generation_id).update(
+            num_annotations=F('num_annotations') + amount)
+    _increment_pairs(pair_counts)
+
+
+def rebuild(batch_size=1000):
+    """Recomputes every counter from the Annotation table."""
+    counts = Annotation.objects.filter(generation=OuterRef('pk')).order_by()
+    counts = counts.values('generation').annotate(count=Count('pk')).values('count')
+
+    with transaction.atomic():
+        Generation.objects.update(num_annotations=Coalesce(
+            Subquery(counts, output_field=IntegerField()), Value(0)))
+
+        AnnotationCount.objects.all().delete()
+        pairs = Annotation.objects.order_by().values('generation', 'playlist').annotate(
+            count=Count('pk'))
+        batch = []
+        for row in pairs.iterator():
+            batch.append(AnnotationCount(
+                generation_id=row['generation'], playlist=row['playlist'], count=row['count']))
+            if len(batch) >= batch_size:
+                AnnotationCount.objects.bulk_create(batch)
+                batch = []
+        AnnotationCount.objects.bulk_create(batch)
@@ -0,0 +1,74 @@
+"""Conditional GET for pages that rarely change.
+
+`render()` takes the same arguments as django.shortcuts.render, but first
+computes an ETag from everything the page depends on:
+
+* the template sources, which only change on deploy;
+* the context the view computed (e.g. the cached playlist listing);
+* the requesting user, as far as base.html shows it: whether they are a
+  registered user and their username;
+* any extra values the view passes as `vary`, e.g. the CSRF cookie of pages
+  with a form.
+
+When the request's If-None-Match matches, it answers 304 Not Modified without
+rendering the template. Otherwise it renders the page as usual and sets the
+ETag. Responses carry `Cache-Control: no-cache`, so browsers and proxies keep
+the page but revalidate it on each visit. SessionMiddleware adds
+`Vary: Cookie`, which keeps proxies from serving one user's page to another.
+
+There is no Last-Modified: the pages depend on who is logged in, which a
+modification date cannot express.
+"""
+import functools
+import hashlib
+import os
+
+from django.conf import settings
+from django.shortcuts import render as render_template
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+
+from core import profiles
+
+
+_TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+
+
+def _template_version():
+    digest = hashlib.md5()
+    for name in sorted(os.listdir(_TEMPLATE_DIR)):
+        status = os.stat(os.path.join(_TEMPLATE_DIR, name))
+        digest.update('{}:{}:{};'.format(name, status.st_mtime_ns, status.st_size).encode())
+    return digest.hexdigest()
+
+
+# Templates only change on deploy, which restarts the workers. Under DEBUG
+# they are edited while the server runs.
+_deployed_template_version = functools.lru_cache(maxsize=1)(_template_version)
+
+
+def _viewer(request):
+    profile = profiles.get(request)
+    if profile is None or profile.is_temporary:
+        return ''
+    return request.user.username
+
+
+def etag(request, template_name, context=None, vary=()):
+    """Returns the quoted ETag of `template_name` rendered with `context` for the requesting user."""
+    version = _template_version() if settings.DEBUG else _deployed_template_version()
+    key = repr((version, template_name, context, _viewer(request), tuple(vary)))
+    return quote_etag(hashlib.md5(key.encode()).hexdigest())
+
+
+def render(request, template_name, context=None, vary=()):
+    """Renders `template_name` like django.shortcuts.render, or answers 304 Not
+    Modified when the client already has this version of the page. `context`
+    must have a stable repr()."""
+    page_etag = etag(request, template_name, context, vary)
+    response = get_conditional_response(request, etag=page_etag)
+    if response is None:
+        response = render_template(request, template_name, context)
+    response['ETag'] = page_etag
+    patch_cache_control(response, no_cache=True)
+    return response
@@ -0,0 +1,29 @@
+"""Cached access to the default FeedbackOption rows.
+
+The default options only change when `populate_database.py` is run, so they are
+read from the shared cache (see core.caching) instead of being queried on every
+page and save.
+"""
+from core import caching
+from core.models import FeedbackOption
+
+
+_CACHE_KEY = 'feedback_options:default'
+# Options are reloaded at least this often (in seconds).
+_CACHE_TIMEOUT = 60 * 60
+
+
+def default_options():
+    """Returns the list of default FeedbackOptions."""
+    return caching.get(
+        _CACHE_KEY,
+        lambda: list(FeedbackOption.objects.filter(is_default=True)),
+        _CACHE_TIMEOUT)
+
+
+def default_options_in(category):
+    return [option for option in default_options() if option.category == category]
+
+
+def invalidate():
+    caching.invalidate(_CACHE_KEY)
@@ -0,0 +1,196 @@
+"""Write-behind ingestion of annotation submissions.
+
+When `settings.ANNOTATION_WRITE_BEHIND` is on, save() and the submit API only
+validate a submission and append it to a local SQLite journal, which is a
+single fsynced insert. A background thread in each worker, started when the
+app loads (or `manage.py flush_annotations`), then moves journaled submissions into the main
+database in batches through `submissions.record`.
+
+Every submission carries an idempotency key that ends up in
+`Annotation.submission_key`:
+
+* appending the same key twice is a no-op, so client retries are harmless;
+* entries are claimed before being flushed and only deleted once the main
+  database transaction has committed. If a worker dies in between, the claim
+  expires and another flush replays the entry, skipping any key that already
+  made it into Annotation.
+
+Entries that cannot be written at all (e.g. they reference a generation that
+no longer exists) are marked with their error and left in the journal for
+inspection instead of being retried forever.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from core import submissions
+from core.models import Generation
+
+
+logger = logging.getLogger(__name__)
+
+# Submissions moved to the main database per flush.
+FLUSH_BATCH_SIZE = 500
+# Seconds between background flushes.
+FLUSH_INTERVAL = 1.0
+# Seconds after which a claimed but unflushed entry is considered abandoned.
+CLAIM_TIMEOUT = 60.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    user_id INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    created REAL NOT NULL,
+    claimed REAL,
+    error TEXT
+)
+"""
+
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def _connect():
+    connection = sqlite3.connect(settings.ANNOTATION_JOURNAL_PATH, timeout=30, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=FULL")
+    connection.execute(_SCHEMA)
+    return connection
+
+
+def append(user_id, parsed):
+    """Durably journals parsed submissions for `user_id`. Submissions whose key
+    is already journaled are ignored."""
+    now = time.time()
+    rows = [(submission['key'], user_id, json.dumps(submission), now) for submission in parsed]
+    connection = _connect()
+    try:
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany(
+                "INSERT OR IGNORE INTO entries (key, user_id, payload, created) VALUES (?, ?, ?, ?)",
+                rows)
+    finally:
+        connection.close()
+    start_flusher()
+
+
+def _claim(connection, limit):
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        rows = connection.execute(
+            "SELECT id, user_id, payload FROM entries "
+            "WHERE error IS NULL AND (claimed IS NULL OR claimed < ?) ORDER BY id LIMIT ?",
+            (now - CLAIM_TIMEOUT, limit)).fetchall()
+        connection.executemany(
+            "UPDATE entries SET claimed = ? WHERE id = ?", [(now, row[0]) for row in rows])
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    return [(entry_id, user_id, json.loads(payload)) for entry_id, user_id, payload in rows]
+
+
+def _write(entries):
+    """Records the given entries in the main database in one transaction.
+    `submissions.record` skips keys that were already written by an earlier,
+    interrupted flush."""
+    by_user = {}
+    for _, user_id, submission in entries:
+        by_user.setdefault(user_id, []).append(submission)
+    with transaction.atomic():
+        for user_id, user_submissions in by_user.items():
+            submissions.record(user_id, user_submissions)
+
+
+def flush(limit=FLUSH_BATCH_SIZE):
+    """Moves up to `limit` journaled submissions into the main database and
+    returns how many entries were processed."""
+    connection = _connect()
+    try:
+        entries = _claim(connection, limit)
+        if not entries:
+            return 0
+
+        generation_ids = {submission['generation_id'] for _, _, submission in entries}
+        existing = set(Generation.objects.filter(
+            pk__in=generation_ids).values_list('pk', flat=True))
+        failed = [(entry_id, 'unknown generation')
+                  for entry_id, _, submission in entries
+                  if submission['generation_id'] not in existing]
+        valid = [entry for entry in entries if entry[2]['generation_id'] in existing]
+
+        try:
+            _write(valid)
+        except Exception:
+            # Write entries one at a time so a single bad entry cannot block the rest.
+            logger.exception("Batch flush failed, retrying entries individually.")
+            for entry in list(valid):
+                try:
+                    _write([entry])
+                except Exception as e:
+                    failed.append((entry[0], repr(e)))
+                    valid.remove(entry)
+
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany(
+                "DELETE FROM entries WHERE id = ?", [(entry[0],) for entry in valid])
+            connection.executemany(
+                "UPDATE entries SET error = ? WHERE id = ?",
+                [(error, entry_id) for entry_id, error in failed])
+        for entry_id, error in failed:
+            logger.error("Could not flush journal entry %s: %s", entry_id, error)
+        return len(entries)
+    finally:
+        connection.close()
+
+
+def flush_all(limit=FLUSH_BATCH_SIZE):
+    """Flushes until the journal has nothing left to claim and returns how
+    many entries were processed."""
+    total = 0
+    while True:
+        flushed = flush(limit)
+        if not flushed:
+            return total
+        total += flushed
+
+
+def pending_count():
+    """Returns the number of entries waiting to be flushed and the number that failed."""
+    connection = _connect()
+    try:
+        return connection.execute(
+            "SELECT COUNT(*) - COUNT(error), COUNT(error) FROM entries").fetchone()
+    finally:
+        connection.close()
+
+
+def _run_flusher():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            flush_all()
+        except Exception:
+            logger.exception("Background flush failed.")
+        finally:
+            close_old_connections()
+
+
+def start_flusher():
+    """Starts this process's background flusher if it is not running yet."""
+    global _flusher
+    with _flusher_lock:
+        if _flusher is None or not _flusher.is_alive():
+            _flusher = threading.Thread(
+                target=_run_flusher, name='annotation-journal-flusher', daemon=True)
+            _flusher.start()
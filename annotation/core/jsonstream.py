@@ -0,0 +1,161 @@
+"""Incremental parsing of large JSON documents.
+
+`JsonStream` reads a JSON document from a file a chunk at a time and hands
+out the members of an object and the elements of an array one at a time, so
+a file with a long array is processed in memory proportional to its largest
+element rather than to the whole file. Like the JSON written by our
+generation scripts, it allows a trailing comma before a closing `}` or `]`.
+"""
+import codecs
+import json
+import re
+
+
+_STRING = r'"(?:[^"\\]|\\.)*"'
+# Inside a container: a string, a quote whose string continues past the end
+# of the buffer, or a bracket.
+_TOKEN = re.compile(_STRING + r'|"|[{}\[\]]')
+_STRING_SCALAR = re.compile(_STRING)
+_LITERAL = re.compile(r'[^\s,:\]}]+')
+_WHITESPACE = re.compile(r'\s*')
+_TRAILING_COMMA = re.compile(_STRING + r'|,(?=\s*[}\]])')
+_DECODER = json.JSONDecoder()
+
+
+def loads(text):
+    """json.loads, allowing trailing commas (outside of strings)."""
+    return json.loads(_TRAILING_COMMA.sub(
+        lambda match: '' if match.group() == ',' else match.group(), text))
+
+
+class JsonStream:
+    """Reads the JSON document in the binary or text file `f` value by value.
+
+    Iterating over `keys()` or `array()` consumes the object or array that
+    comes next in the document; the value of each key must be consumed with
+    `value()`, `array()`, `keys()` or `skip()` before asking for the next one.
+    """
+
+    def __init__(self, f, chunk_size=1 << 16):
+        self._file = f
+        self._chunk_size = chunk_size
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """Reads the next chunk of the file, dropping the consumed part of the buffer."""
+        chunk = self._file.read(self._chunk_size)
+        self._eof = not chunk
+        if isinstance(chunk, bytes):
+            chunk = self._decoder.decode(chunk, final=self._eof)
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+
+    def _peek(self):
+        """Skips whitespace and returns the next character, or '' at the end of the document."""
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or self._eof:
+                return self._buffer[self._pos:self._pos + 1]
+            self._fill()
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError('Expected {!r} in JSON document at {!r}'.format(
+                char, self._buffer[self._pos:self._pos + 40]))
+        self._pos += 1
+
+    def _raw_scalar(self):
+        scalar = _STRING_SCALAR if self._peek() == '"' else _LITERAL
+        while True:
+            match = scalar.match(self._buffer, self._pos)
+            if match is not None and (match.end() < len(self._buffer) or self._eof):
+                self._pos = match.end()
+                return match.group()
+            if self._eof:
+                raise ValueError('Unexpected end of JSON document')
+            self._fill()
+
+    def _raw_container(self):
+        depth = 0
+        scan = self._pos
+        while True:
+            for match in _TOKEN.finditer(self._buffer, scan):
+                token = match.group()
+                if token == '"':
+                    # The string continues in the next chunk.
+                    scan = match.start()
+                    break
+                if token[0] == '"':
+                    continue
+                depth += 1 if token in '{[' else -1
+                if depth == 0:
+                    text = self._buffer[self._pos:match.end()]
+                    self._pos = match.end()
+                    return text
+            else:
+                scan = len(self._buffer)
+            if self._eof:
+                raise ValueError('Unexpected end of JSON document')
+            offset = scan - self._pos
+            self._fill()
+            scan = offset
+
+    def _raw_value(self):
+        """Consumes the next value and returns its JSON text."""
+        if self._peek() in ('{', '['):
+            return self._raw_container()
+        return self._raw_scalar()
+
+    def _skip_comma(self):
+        if self._peek() == ',':
+            self._pos += 1
+
+    def value(self):
+        """Consumes and returns the next value."""
+        self._peek()
+        try:
+            value, end = _DECODER.raw_decode(self._buffer, self._pos)
+        except ValueError:
+            # Cut off by the end of the buffer, or has a trailing comma.
+            pass
+        else:
+            # A number or literal running up to the end of the buffer may
+            # continue in the next chunk.
+            if (isinstance(value, (dict, list, str)) or self._eof
+                    or _LITERAL.match(self._buffer, self._pos).end() < len(self._buffer)):
+                self._pos = end
+                return value
+        return loads(self._raw_value())
+
+    def keys(self):
+        """Iterates over the keys of the object that comes next."""
+        self._expect('{')
+        while self._peek() != '}':
+            key = json.loads(self._raw_scalar())
+            self._expect(':')
+            yield key
+            self._skip_comma()
+        self._pos += 1
+
+    def array(self):
+        """Iterates over the elements of the array that comes next, decoding one at a time."""
+        self._expect('[')
+        while self._peek() != ']':
+            yield self.value()
+            self._skip_comma()
+        self._pos += 1
+
+    def skip(self):
+        """Consumes the next value without holding all of it in memory."""
+        first = self._peek()
+        if first == '{':
+            for _ in self.keys():
+                self.skip()
+        elif first == '[':
+            for _ in self.array():
+                pass
+        else:
+            self._raw_scalar()
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from core import boundaries
+
+
+class Command(BaseCommand):
+    help = ('Fills in Generation.boundary and Annotation.distance/is_correct for rows saved '
+            'before they were stored.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch_size', type=int, default=5000)
+        parser.add_argument('--force', action='store_true',
+                            help='Recompute every row, not only the missing ones.')
+
+    def handle(self, *args, **options):
+        generations, annotations = boundaries.backfill(
+            batch_size=options['batch_size'], force=options['force'])
+        self.stdout.write('Updated {} generations and {} annotations.'.format(
+            generations, annotations))
@@ -0,0 +1,82 @@
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from populate_database import _read_generations, _read_json
+
+
+def _write_generations(path, records, seed):
+    """Writes a generations file like the ones populate_database.py loads,
+    with the trailing commas our generation scripts leave in."""
+    rng = random.Random(seed)
+    words = ['the', 'a', 'recipe', 'said', 'president', 'story', 'water', 'minutes', 'nation']
+
+    def sentences(count):
+        return [' '.join(rng.choice(words) for _ in range(rng.randint(5, 25))) + '.'
+                for _ in range(count)]
+
+    with open(path, 'w') as f:
+        f.write('{\n    "date-generated": "2021-01-01",\n    "generation-model": "benchmark",\n'
+                '    "dataset": "benchmark",\n    "split": "dev",\n    "generations": [\n')
+        for i in range(records):
+            f.write(json.dumps({
+                'prompt-index': i,
+                'prompt': sentences(rng.randint(1, 9)),
+                'generation': sentences(rng.randint(1, 9)),
+                'p': rng.choice([0.0, 0.4, 1.0]),
+            }, indent=4) + ',\n')
+        f.write('    ],\n}\n')
+
+
+def _current(path):
+    with open(path, 'rb') as f:
+        generations = _read_json(f)['generations']
+    return sum(1 for _ in generations)
+
+
+def _streaming(path):
+    _, generations = _read_generations(path)
+    return sum(1 for _ in generations)
+
+
+class Command(BaseCommand):
+    help = ('Compares the time and peak memory of parsing a generations file with '
+            'populate_database.py\'s read-and-regex `_read_json` and with the streaming '
+            'parser in core.jsonstream.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help='Generations file to parse. Without it, a file with '
+                            '--records generations is written to a temporary directory.')
+        parser.add_argument('--records', type=int, default=20000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as directory:
+            path = options['path']
+            if not path:
+                path = os.path.join(directory, 'generations.json')
+                _write_generations(path, options['records'], options['seed'])
+            self._compare(path)
+
+    def _compare(self, path):
+        self.stdout.write('{} ({:.1f} MB)'.format(path, os.path.getsize(path) / 2**20))
+        self.stdout.write('{:<16} {:>8} {:>10} {:>14}'.format('parser', 'records', 'seconds', 'peak MB'))
+        for name, parse in (('read and regex', _current), ('streaming', _streaming)):
+            start = time.perf_counter()
+            records = parse(path)
+            elapsed = time.perf_counter() - start
+
+            # Measured in a second run, since tracemalloc slows parsing down.
+            tracemalloc.start()
+            try:
+                parse(path)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            self.stdout.write('{:<16} {:>8} {:>10.2f} {:>14.1f}'.format(
+                name, records, elapsed, peak / 2**20))
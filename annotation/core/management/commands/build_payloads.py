@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from core import payloads
+
+
+class Command(BaseCommand):
+    help = 'Precomputes the annotate page payload of every generation with a stale one.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch_size', type=int, default=1000)
+        parser.add_argument('--force', action='store_true',
+                            help='Rebuild every payload, not only stale ones.')
+
+    def handle(self, *args, **options):
+        built = payloads.rebuild(batch_size=options['batch_size'], force=options['force'])
+        self.stdout.write('Built {} payloads.'.format(built))
@@ -0,0 +1,248 @@
+import json
+import random
+import os
+import tempfile
+from io import StringIO
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.urls import get_resolver
+
+from core import assignment
+from core.management.commands.generate_fixtures import PASSWORD
+from core.models import FeedbackOption, Playlist, Profile
+from core.views import _PLAYLIST_VERSION
+
+
+# The most SQL queries and the most rows fetched by any request to each route,
+# keyed by URL name: what the routes measure, with a small margin where the
+# count depends on the data. Neither may grow with the amount of data, so the
+# same budget applies at every scale.
+BUDGETS = {
+    'play': (3, 2),
+    'sign_up': (14, 6),
+    'log_in': (7, 2),
+    'join': (3, 4),
+    'help': (3, 4),
+    'about': (3, 4),
+    # The top rankings.LEADERBOARD_SIZE users and the viewer's own entry.
+    'leaderboard': (6, 60),
+    'profile': (5, 6),
+    # Searches up to three assignment tiers, from a random starting point.
+    'annotate': (13, 12),
+    # MAX_PREFETCH items, each leased with a few queries; more rounds are
+    # needed while many of the first candidates are taken.
+    'next_items': (48, 30),
+    # Includes creating and logging in the temporary user of a new visitor.
+    'save': (22, 5),
+    # A batch of five submissions, whose generations are checked in one query;
+    # each one costs one Annotation insert and fetches its generation's boundary.
+    # Once the cached leaderboard is full, the new total is compared against it.
+    'submit': (23, 10),
+    'metrics': (0, 0),
+    'log_out': (4, 4),
+}
+
+# Routes that list every playlist: their rows budget is per playlist. The play
+# page fetches each playlist and its annotation total.
+_PER_PLAYLIST = {'play'}
+
+# Routes that are not ours to budget.
+_UNCHECKED = {'admin'}
+
+# Arguments to `manage.py generate_fixtures` for each scale.
+SCALES = {
+    'small': {'users': 20, 'generations': 50, 'annotations': 500, 'prompts': 25, 'playlists': 4},
+    'medium': {'users': 200, 'generations': 500, 'annotations': 5000, 'prompts': 250,
+               'playlists': 12},
+    'large': {'users': 2000, 'generations': 5000, 'annotations': 50000, 'prompts': 2500,
+              'playlists': 40},
+}
+
+
+class _Recorder:
+    """Counts the queries a request runs and the rows its SELECTs return. Rows
+    are counted by re-running each SELECT wrapped in a COUNT(*)."""
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+        self._counting = False
+
+    def __call__(self, execute, sql, params, many, context):
+        result = execute(sql, params, many, context)
+        if self._counting:
+            return result
+        self.queries += 1
+        if sql.lstrip().upper().startswith('SELECT'):
+            self._counting = True
+            try:
+                with context['connection'].cursor() as cursor:
+                    cursor.execute('SELECT COUNT(*) FROM ({}) counted'.format(sql), params)
+                    self.rows += cursor.fetchone()[0]
+            finally:
+                self._counting = False
+        return result
+
+
+def _route_names():
+    names = set()
+    for pattern in get_resolver().url_patterns:
+        name = getattr(pattern, 'name', None) or str(pattern.pattern).strip('/')
+        names.add(name)
+    return names - _UNCHECKED
+
+
+def _growth(measured):
+    """Returns a failure for every request whose query count rises at each step
+    from the smallest scale in `measured` to the largest. `measured` maps
+    scales, smallest first, to the (route, queries) of each request in order.
+    Counts that depend on the shape of the data, such as how many assignment
+    tiers have to be searched, may differ between scales without rising at
+    every step."""
+    scales = list(measured)
+    failures = []
+    if len(scales) < 2:
+        return failures
+    for requests in zip(*(measured[scale] for scale in scales)):
+        counts = [queries for _, queries in requests]
+        if all(larger > smaller for smaller, larger in zip(counts, counts[1:])):
+            failures.append('{} runs {} queries at the {} scales'.format(
+                requests[0][0], ', '.join(map(str, counts)), ', '.join(scales)))
+    return failures
+
+
+class Command(BaseCommand):
+    help = ('Requests every route against a throwaway database filled at three scales with '
+            '`generate_fixtures`, and fails if a route runs more SQL queries or fetches more '
+            'rows than its budget in BUDGETS, or more queries at a larger scale than at the '
+            'smallest.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', nargs='+', choices=list(SCALES), default=list(SCALES))
+
+    def handle(self, *args, **options):
+        unbudgeted = _route_names() - set(BUDGETS)
+        if unbudgeted:
+            raise CommandError('Routes without a query budget: {}'.format(
+                ', '.join(sorted(unbudgeted))))
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        failures = []
+        measured = {}
+        try:
+            # Budgets cover the synchronous write path.
+            with tempfile.TemporaryDirectory() as directory, override_settings(
+                    ANNOTATION_WRITE_BEHIND=False, METRICS=True,
+                    METRICS_PATH=os.path.join(directory, 'metrics.sqlite3'),
+                    CACHE_PATH=directory, CACHES={'default': {
+                        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                        'LOCATION': directory}}):
+                for scale in options['scales']:
+                    scale_failures, measured[scale] = self._check(scale, SCALES[scale])
+                    failures.extend(scale_failures)
+                failures.extend(_growth(measured))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        if failures:
+            raise CommandError('{} routes over budget:\n{}'.format(
+                len(failures), '\n'.join(failures)))
+        self.stdout.write('All routes within budget.')
+
+    def _check(self, scale, fixtures):
+        call_command('flush', interactive=False, verbosity=0)
+        cache.clear()
+        call_command('generate_fixtures', stdout=StringIO(), **fixtures)
+        # Assignment starts from a random generation; the same choices at every
+        # scale keep the counts comparable.
+        random.seed(0)
+
+        self.stdout.write('{} ({} users, {} generations, {} prompts, {} playlists, {} annotations)'.format(
+            scale, fixtures['users'], fixtures['generations'], fixtures['prompts'],
+            fixtures['playlists'], fixtures['annotations']))
+        self.stdout.write('  {:<12} {:>7} {:>7} {:>7} {:>7}'.format(
+            'route', 'queries', 'budget', 'rows', 'budget'))
+        failures = []
+        measured = []
+        for name, queries, rows in self._requests():
+            measured.append((name, queries))
+            max_queries, max_rows = BUDGETS[name]
+            if name in _PER_PLAYLIST:
+                max_rows *= fixtures['playlists']
+            over = queries > max_queries or rows > max_rows
+            self.stdout.write('  {:<12} {:>7} {:>7} {:>7} {:>7}{}'.format(
+                name, queries, max_queries, rows, max_rows, '  OVER BUDGET' if over else ''))
+            if over:
+                failures.append('{} at {} scale: {} queries (budget {}), {} rows (budget {})'.format(
+                    name, scale, queries, max_queries, rows, max_rows))
+        return failures, measured
+
+    def _request(self, client, name, method, path, data=None, **extra):
+        recorder = _Recorder()
+        with connection.execute_wrapper(recorder):
+            response = getattr(client, method)(path, data, **extra)
+        if response.status_code >= 400:
+            raise CommandError('{} {} returned {}'.format(method.upper(), path, response.status_code))
+        return name, recorder.queries, recorder.rows
+
+    def _requests(self):
+        """Yields (route, queries, rows) for a request to every budgeted route."""
+        playlist = Playlist.objects.filter(version=_PLAYLIST_VERSION).first()
+        profile = Profile.objects.filter(
+            is_temporary=False, source='benchmark').select_related('user').first()
+        user = profile.user
+        reasons = list(FeedbackOption.objects.filter(
+            is_default=True).values_list('shortname', flat=True))
+
+        # A new visitor, who becomes a temporary user by saving an annotation and then signs up.
+        visitor = Client()
+        yield self._request(visitor, 'play', 'get', '/')
+        yield self._request(visitor, 'annotate', 'get', '/annotate/?playlist={}'.format(playlist.id))
+        generation = assignment.next_generations(None, playlist.id)[0]
+        yield self._request(visitor, 'save', 'post', '/save/', {
+            'text': generation.id, 'playlist_id': playlist.id, 'boundary': 0, 'points': 0,
+            'timestamps': '1600000000000,1600000003000'})
+        yield self._request(visitor, 'sign_up', 'post', '/signup/', {
+            'username': 'budget-visitor', 'password': PASSWORD, 'password2': PASSWORD,
+            'user_source': 'benchmark'})
+
+        client = Client()
+        yield self._request(client, 'log_in', 'post', '/login/', {
+            'username': user.username, 'password': PASSWORD})
+        yield self._request(client, 'play', 'get', '/')
+        yield self._request(client, 'join', 'get', '/join/')
+        yield self._request(client, 'help', 'get', '/help/')
+        yield self._request(client, 'about', 'get', '/about/')
+        yield self._request(client, 'leaderboard', 'get', '/leaderboard/')
+        yield self._request(client, 'profile', 'get', '/profile/{}/'.format(user.username))
+        yield self._request(client, 'annotate', 'get', '/annotate/?playlist={}'.format(playlist.id))
+        yield self._request(client, 'next_items', 'get', '/api/next/?playlist={}&count={}'.format(
+            playlist.id, 10))
+
+        generations = assignment.next_generations(user, playlist.id, count=6)
+        submissions = [{
+            'text': generation.id,
+            'playlist_id': playlist.id,
+            'boundary': 3,
+            'points': 2,
+            'attention_check': 0,
+            'timestamps': ','.join(str(1600000000000 + 3000 * i) for i in range(5)),
+            'other_reason': 'budget check',
+            **{reason: 'true' for reason in reasons},
+        } for generation in generations]
+        yield self._request(client, 'save', 'post', '/save/', submissions[0])
+        for submission in submissions[1:]:
+            submission['timestamps'] = [int(t) for t in submission['timestamps'].split(',')]
+            submission['reasons'] = reasons
+        yield self._request(client, 'submit', 'post', '/api/submit/', json.dumps(
+            {'submissions': submissions[1:]}), content_type='application/json')
+
+        yield self._request(client, 'metrics', 'get', '/metrics')
+        yield self._request(client, 'log_out', 'get', '/logout/')
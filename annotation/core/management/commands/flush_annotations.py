@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from core import journal
+
+
+class Command(BaseCommand):
+    help = 'Writes submissions waiting in the write-behind annotation journal to the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch_size', type=int, default=journal.FLUSH_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        flushed = journal.flush_all(limit=options['batch_size'])
+        waiting, failed = journal.pending_count()
+        self.stdout.write('Flushed {} submissions; {} waiting, {} failed.'.format(
+            flushed, waiting, failed))
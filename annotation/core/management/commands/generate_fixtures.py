@@ -0,0 +1,175 @@
+import csv
+import random
+import time
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from core import boundaries, counters, payloads, rankings, timestamps
+from core.models import (
+    Annotation, Dataset, DecodingStrategy, FeedbackOption, Generation, Playlist, Profile, Prompt,
+    SEP, System)
+from core.views import _PLAYLIST_VERSION, _PROFILE_PLAYLISTS
+
+
+# Password of every generated user, so load tests can log in as them.
+PASSWORD = 'benchmark-password'
+
+
+def _next_id(model):
+    return (model.objects.aggregate(max_id=Max('pk'))['max_id'] or 0) + 1
+
+
+class Command(BaseCommand):
+    help = ('Fills the core tables with synthetic users, generations and annotations at a '
+            'configurable scale, using bulk inserts. Meant for load testing only.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--generations', type=int, default=5000)
+        parser.add_argument('--annotations', type=int, default=50000)
+        parser.add_argument('--prompts', type=int,
+                            help='Prompts the generations are spread over. One per generation by default.')
+        parser.add_argument('--playlists', type=int,
+                            help='Playlists the generations are split between. One per profile '
+                                 'category by default.')
+        parser.add_argument('--timestamps', type=int, default=4,
+                            help='Timestamps per annotation.')
+        parser.add_argument('--temporary_fraction', type=float, default=0.5,
+                            help='Fraction of users that are temporary (not signed up).')
+        parser.add_argument('--playlist_version', default=_PLAYLIST_VERSION)
+        parser.add_argument('--batch_size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def _bulk(self, model, objects, batch_size):
+        for start in range(0, len(objects), batch_size):
+            with transaction.atomic():
+                model.objects.bulk_create(objects[start:start + batch_size])
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        batch_size = options['batch_size']
+        start_time = time.time()
+
+        self._feedback_options()
+        system, _ = System.objects.get_or_create(
+            name='benchmark', defaults={'description': 'Synthetic benchmark data'})
+        dataset, _ = Dataset.objects.get_or_create(name='benchmark', split='test')
+        strategies = [DecodingStrategy.objects.get_or_create(name='top-p', value=p)[0]
+                      for p in (0.0, 0.4, 1.0)]
+
+        # Prompts and generations, with their display payloads precomputed.
+        first_prompt_index = (Prompt.objects.filter(dataset=dataset).aggregate(
+            max_index=Max('prompt_index'))['max_index'] or 0) + 1
+        first_prompt_id = _next_id(Prompt)
+        prompts, generations = [], []
+        for i in range(options['prompts'] or options['generations']):
+            num_sentences = rng.randint(1, 10)
+            prompts.append(Prompt(
+                id=first_prompt_id + i,
+                body=SEP.join('Prompt {} sentence {}.'.format(i, j) for j in range(num_sentences)),
+                num_sentences=num_sentences,
+                dataset=dataset,
+                prompt_index=first_prompt_index + i))
+        first_generation_id = _next_id(Generation)
+        for i in range(options['generations']):
+            prompt = prompts[i % len(prompts)]
+            body = SEP.join('Generation {} sentence {}.'.format(i, j)
+                            for j in range(10 - prompt.num_sentences))
+            generations.append(Generation(
+                id=first_generation_id + i,
+                system=system,
+                prompt=prompt,
+                decoding_strategy=rng.choice(strategies),
+                body=body,
+                boundary=boundaries.true_boundary(prompt.num_sentences),
+                **payloads.serialize(prompt.body, prompt.num_sentences, body)))
+        self._bulk(Prompt, prompts, batch_size)
+        self._bulk(Generation, generations, batch_size)
+        self.stdout.write('Created {} generations.'.format(len(generations)))
+
+        # One playlist per profile category, then numbered ones, splitting the
+        # generations between them.
+        names = list(filter(None, _PROFILE_PLAYLISTS.values()))
+        num_playlists = options['playlists'] or len(names)
+        names += ['Benchmark {}'.format(i) for i in range(len(names), num_playlists)]
+        playlists = []
+        for name in names[:num_playlists]:
+            playlist, _ = Playlist.objects.get_or_create(
+                shortname=name, version=options['playlist_version'],
+                defaults={'name': name, 'description': 'Synthetic **{}**.'.format(name),
+                          'details': 'Benchmark data.'})
+            playlists.append(playlist)
+        Membership = Playlist.generations.through
+        self._bulk(Membership, [
+            Membership(playlist_id=playlists[i % len(playlists)].id, generation_id=generation.id)
+            for i, generation in enumerate(generations)], batch_size)
+
+        # Users share one password hash so generating them stays cheap.
+        password = make_password(PASSWORD)
+        first_user_id = _next_id(User)
+        users, profiles = [], []
+        for i in range(options['users']):
+            user_id = first_user_id + i
+            temporary = rng.random() < options['temporary_fraction']
+            users.append(User(
+                id=user_id,
+                username='bench-{}'.format(user_id),
+                password=make_password(None) if temporary else password))
+            profiles.append(Profile(user_id=user_id, is_temporary=temporary, source='benchmark'))
+        self._bulk(User, users, batch_size)
+        self._bulk(Profile, profiles, batch_size)
+        self.stdout.write('Created {} users.'.format(len(users)))
+
+        # Annotations with a few timestamps each, written in batches.
+        first_annotation_id = _next_id(Annotation)
+        playlist_of = {m.generation_id: str(m.playlist_id) for m in Membership.objects.filter(
+            generation_id__in=[g.id for g in generations])}
+        now = timezone.now()
+        created = 0
+        while created < options['annotations']:
+            annotations = []
+            for i in range(min(batch_size, options['annotations'] - created)):
+                generation = rng.choice(generations)
+                boundary = rng.randint(0, 9)
+                true_boundary = generation.boundary
+                started = timestamps.to_milliseconds(
+                    now - timedelta(seconds=rng.randint(0, 365 * 24 * 3600)))
+                annotations.append(Annotation(
+                    id=first_annotation_id + created + i,
+                    annotator_id=rng.choice(users).id,
+                    generation_id=generation.id,
+                    playlist=playlist_of[generation.id],
+                    boundary=boundary,
+                    points=max(5 - (boundary - true_boundary), 0) if boundary >= true_boundary else 0,
+                    attention_check=False,
+                    packed_timestamps=timestamps.pack(
+                        [started + 5000 * j for j in range(options['timestamps'])]),
+                    **boundaries.score(boundary, true_boundary)))
+            with transaction.atomic():
+                Annotation.objects.bulk_create(annotations)
+            created += len(annotations)
+            self.stdout.write('Created {} annotations.'.format(created))
+
+        # Explicit ids leave sequences behind on Postgres.
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(
+                    no_style(), [Prompt, Generation, User, Profile, Annotation]):
+                cursor.execute(sql)
+
+        counters.rebuild()
+        rankings.rebuild()
+        self.stdout.write('Done in {:.1f}s. Generated users log in with password "{}".'.format(
+            time.time() - start_time, PASSWORD))
+
+    def _feedback_options(self):
+        with open('feedback_default_options.csv') as csv_file:
+            for row in list(csv.reader(csv_file, delimiter=','))[1:]:
+                FeedbackOption.objects.get_or_create(
+                    shortname=row[0], defaults={'category': row[1], 'description': row[2]})
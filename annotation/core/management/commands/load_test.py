@@ -0,0 +1,168 @@
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from core.models import FeedbackOption, Playlist
+from core.views import _PLAYLIST_VERSION
+
+
+_TEXT_ID = re.compile(r'(?:const|let) text_id = "(\d+)"')
+_NAME = re.compile(r'(?:const|let) name = "([^"]*)"')
+_MAX_SENTENCES = re.compile(r'(?:const|let) max_sentences = (\d+)')
+
+
+class _HttpTransport:
+    """Talks to a running server. Query counts are read from the X-Query-Count
+    header, which the server sends when QUERY_COUNT_HEADER=True."""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+
+    def request(self, method, path, data=None):
+        response = self.session.request(method, self.url + path, data=data, allow_redirects=False)
+        queries = response.headers.get('X-Query-Count')
+        return response.status_code, response.text, int(queries) if queries is not None else None
+
+
+class _InProcessTransport:
+    """Calls the views in this process through the Django test client."""
+
+    def __init__(self):
+        self.client = Client()
+
+    def request(self, method, path, data=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method.lower())(path, data or {})
+        return response.status_code, response.content.decode(), len(queries)
+
+
+class _Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, view, seconds, status, queries):
+        with self.lock:
+            self.latencies[view].append(seconds)
+            if queries is not None:
+                self.queries[view].append(queries)
+            if status >= 400:
+                self.errors[view] += 1
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Command(BaseCommand):
+    help = ('Replays annotate->save sessions against the site and reports latency '
+            'percentiles, throughput and SQL queries per view. Pair with '
+            '`manage.py generate_fixtures` to test at scale.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='Base URL of a running server, e.g. '
+                            'http://127.0.0.1:8000. Without it, views are called in-process.')
+        parser.add_argument('--sessions', type=int, default=20)
+        parser.add_argument('--annotations_per_session', type=int, default=10)
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help='Concurrent sessions (HTTP mode only).')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.playlist_ids = list(Playlist.objects.filter(
+            version=_PLAYLIST_VERSION).values_list('id', flat=True)) or [-1]
+        self.reasons = list(FeedbackOption.objects.filter(
+            is_default=True).values_list('shortname', flat=True))
+        self.options = options
+        self.stats = _Stats()
+
+        if options['url']:
+            make_transport = lambda: _HttpTransport(options['url'])
+            concurrency = options['concurrency']
+        else:
+            # The test client and SQLite do not mix well with threads.
+            make_transport = _InProcessTransport
+            concurrency = 1
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(
+                lambda seed: self._session(make_transport(), random.Random(seed)),
+                range(options['seed'], options['seed'] + options['sessions'])))
+        elapsed = time.time() - start
+
+        self._report(elapsed, 'HTTP ' + options['url'] if options['url'] else
+                     'in-process ({})'.format(connection.vendor))
+
+    def _call(self, transport, view, method, path, data=None):
+        start = time.time()
+        status, body, queries = transport.request(method, path, data)
+        self.stats.record(view, time.time() - start, status, queries)
+        return status, body
+
+    def _session(self, transport, rng):
+        # A new visitor lands on the play page, then annotates a playlist. Their
+        # first save signs them in as a temporary user.
+        self._call(transport, 'play', 'GET', '/')
+        playlist_id = rng.choice(self.playlist_ids)
+        name = None
+        for _ in range(self.options['annotations_per_session']):
+            status, body = self._call(
+                transport, 'annotate', 'GET', '/annotate/?playlist={}'.format(playlist_id))
+            text_id = _TEXT_ID.search(body) if status == 200 else None
+            if not text_id:
+                break
+            name = _NAME.search(body).group(1)
+            max_sentences = int(_MAX_SENTENCES.search(body).group(1))
+
+            boundary = rng.randint(0, max_sentences)
+            started = int(time.time() * 1000)
+            data = {
+                'text': text_id.group(1),
+                'name': name,
+                'playlist_id': playlist_id,
+                'boundary': boundary,
+                'points': rng.randint(0, 5),
+                'attention_check': 0,
+                'timestamps': ','.join(str(started + 3000 * i) for i in range(boundary + 2)),
+                'other_reason': '',
+            }
+            for reason in self.reasons:
+                data[reason] = 'true' if rng.random() < 0.2 else 'false'
+            self._call(transport, 'save', 'POST', '/save/', data)
+
+        self._call(transport, 'leaderboard', 'GET', '/leaderboard/')
+        if name:
+            self._call(transport, 'profile', 'GET', '/profile/{}/'.format(name))
+
+    def _report(self, elapsed, label):
+        stats = self.stats
+        total = sum(len(values) for values in stats.latencies.values())
+        self.stdout.write('{}: {} requests in {:.1f}s ({:.1f} req/s)'.format(
+            label, total, elapsed, total / elapsed if elapsed else 0))
+        self.stdout.write('{:<12} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8} {:>7}'.format(
+            'view', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'queries', 'errors'))
+        for view, latencies in sorted(stats.latencies.items()):
+            queries = stats.queries.get(view)
+            self.stdout.write('{:<12} {:>6} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8} {:>7}'.format(
+                view,
+                len(latencies),
+                1000 * _percentile(latencies, 0.50),
+                1000 * _percentile(latencies, 0.95),
+                1000 * _percentile(latencies, 0.99),
+                len(latencies) / elapsed if elapsed else 0,
+                '{:.1f}'.format(sum(queries) / len(queries)) if queries else '-',
+                stats.errors[view]))
@@ -0,0 +1,48 @@
+import time
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core import timestamps
+from core.models import Annotation, Timestamp
+
+
+class Command(BaseCommand):
+    help = ('Packs the Timestamp rows of annotations saved before timestamps were stored on '
+            'Annotation into Annotation.packed_timestamps, optionally deleting the rows.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch_size', type=int, default=1000)
+        parser.add_argument('--delete', action='store_true',
+                            help='Delete the Timestamp rows once they are packed.')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        unpacked = Annotation.objects.filter(packed_timestamps__isnull=True).order_by('pk')
+        packed, deleted, last_pk = 0, 0, 0
+        while True:
+            annotation_ids = list(unpacked.filter(pk__gt=last_pk).values_list(
+                'pk', flat=True)[:options['batch_size']])
+            if not annotation_ids:
+                break
+            last_pk = annotation_ids[-1]
+
+            dates = defaultdict(list)
+            rows = Timestamp.objects.filter(annotation_id__in=annotation_ids).order_by(
+                'annotation_id', 'date', 'pk').values_list('annotation_id', 'date')
+            for annotation_id, date in rows:
+                dates[annotation_id].append(timestamps.to_milliseconds(date))
+
+            with transaction.atomic():
+                Annotation.objects.bulk_update([
+                    Annotation(pk=pk, packed_timestamps=timestamps.pack(dates[pk]))
+                    for pk in annotation_ids], ['packed_timestamps'])
+                if options['delete']:
+                    deleted += Timestamp.objects.filter(
+                        annotation_id__in=annotation_ids).delete()[0]
+            packed += len(annotation_ids)
+            self.stdout.write('Packed {} annotations so far.'.format(packed))
+
+        self.stdout.write('Packed {} annotations and deleted {} Timestamp rows in {:.1f}s.'.format(
+            packed, deleted, time.time() - start))
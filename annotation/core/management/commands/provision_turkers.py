@@ -0,0 +1,117 @@
+import csv
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from amt.generate_usernames import generate_usernames
+from core.models import Profile, User
+
+
+def _init_worker():
+    # Workers started with "spawn" rather than "fork" import Django afresh.
+    if not apps.ready:
+        django.setup()
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _existing_usernames(usernames, batch_size):
+    existing = set()
+    for chunk in _chunks(list(usernames), batch_size):
+        existing.update(User.objects.filter(username__in=chunk).values_list('username', flat=True))
+    return existing
+
+
+def unique_usernames(candidates, batch_size):
+    """Returns `candidates` with every name that is already taken, by an
+    existing user or an earlier candidate, replaced by the first free
+    `<name>_<n>`. Taken names are looked up a batch at a time, once per
+    suffix tried, never one user at a time."""
+    usernames = [User.normalize_username(candidate) for candidate in candidates]
+    resolved = [None] * len(usernames)
+    taken = set()
+    suffixes = [1] * len(usernames)
+    pending = list(range(len(usernames)))
+    while pending:
+        proposals = {i: usernames[i] if suffixes[i] == 1 else '{}_{}'.format(usernames[i], suffixes[i])
+                     for i in pending}
+        existing = _existing_usernames(set(proposals.values()), batch_size)
+        still_pending = []
+        for i in pending:
+            if proposals[i] in existing or proposals[i] in taken:
+                suffixes[i] += 1
+                still_pending.append(i)
+            else:
+                resolved[i] = proposals[i]
+                taken.add(proposals[i])
+        pending = still_pending
+    return resolved
+
+
+class Command(BaseCommand):
+    help = ('Creates turker accounts with generated usernames and random passwords, and writes '
+            'their credentials to a CSV file. Passwords are hashed in a process pool and users '
+            'and profiles are inserted in batches.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('count', type=int)
+        parser.add_argument('--output', default='users.csv')
+        parser.add_argument('--batch_size', type=int, default=500)
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Processes hashing passwords.')
+        parser.add_argument('--source', default='amt')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        # generate_usernames reads its word lists from the working directory.
+        cwd = os.getcwd()
+        os.chdir(os.path.join(settings.BASE_DIR, 'amt'))
+        try:
+            candidates = generate_usernames(options['count'])
+        finally:
+            os.chdir(cwd)
+        usernames = unique_usernames(candidates, options['batch_size'])
+        renamed = sum(1 for candidate, username in zip(candidates, usernames) if candidate != username)
+
+        # Forked workers must not share this process's database connections.
+        connections.close_all()
+        created = 0
+        with open(options['output'], 'w', newline='') as f, ProcessPoolExecutor(
+                max_workers=options['workers'], initializer=_init_worker) as executor:
+            writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+            writer.writerow(['username', 'password'])
+            for batch in _chunks(usernames, options['batch_size']):
+                passwords = [uuid.uuid4().hex for _ in batch]
+                hashes = list(executor.map(make_password, passwords,
+                                           chunksize=max(1, len(batch) // (4 * options['workers']))))
+                with transaction.atomic():
+                    User.objects.bulk_create([
+                        User(username=username, password=password_hash, email='')
+                        for username, password_hash in zip(batch, hashes)])
+                    # Not every backend returns the primary keys of bulk inserted rows.
+                    user_ids = dict(User.objects.filter(username__in=batch).values_list('username', 'id'))
+                    Profile.objects.bulk_create([
+                        Profile(user_id=user_ids[username], is_turker=True, source=options['source'])
+                        for username in batch])
+                # Only credentials of committed users are written.
+                writer.writerows(zip(batch, passwords))
+                f.flush()
+                created += len(batch)
+                self.stdout.write('Created {} of {} users.'.format(created, len(usernames)))
+
+        elapsed = time.time() - start
+        self.stdout.write('Created {} users ({} renamed to avoid existing usernames) in {:.1f}s '
+                          '({:.0f} users/s). Credentials are in {}.'.format(
+                              created, renamed, elapsed, created / elapsed if elapsed else 0,
+                              options['output']))
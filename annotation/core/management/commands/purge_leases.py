@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from core.assignment import purge_expired_leases
+
+
+class Command(BaseCommand):
+    help = 'Deletes expired annotation leases.'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Deleted {} expired leases.'.format(purge_expired_leases()))
@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core import cleanup
+
+
+class Command(BaseCommand):
+    help = ('Deletes temporary users that never saved an annotation and have been idle for '
+            '--days, plus expired sessions, in small batches that are safe to run against a '
+            'live database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30,
+                            help='Days since the last login after which a temporary user is abandoned.')
+        parser.add_argument('--batch_size', type=int, default=500)
+        parser.add_argument('--pause', type=float, default=0.1,
+                            help='Seconds to sleep between batches.')
+        parser.add_argument('--archive',
+                            help='CSV file to append the deleted users to.')
+        parser.add_argument('--skip_sessions', action='store_true')
+        parser.add_argument('--every', type=float,
+                            help='Keep running, purging again every this many seconds.')
+
+    def handle(self, *args, **options):
+        while True:
+            self._purge('temporary users', cleanup.purge_temporary_users(
+                idle_days=options['days'],
+                batch_size=options['batch_size'],
+                pause=options['pause'],
+                archive=options['archive']))
+            if not options['skip_sessions']:
+                self._purge('expired sessions', cleanup.purge_expired_sessions(
+                    batch_size=options['batch_size'], pause=options['pause']))
+            if not options['every']:
+                return
+            time.sleep(options['every'])
+
+    def _purge(self, label, batches):
+        start = time.time()
+        total = 0
+        for deleted in batches:
+            total += deleted
+            self.stdout.write('Deleted {} {} so far.'.format(total, label))
+        elapsed = time.time() - start
+        self.stdout.write('Deleted {} {} in {:.1f}s ({:.0f} rows/s).'.format(
+            total, label, elapsed, total / elapsed if elapsed else 0))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from core import counters
+from core.models import AnnotationCount
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the denormalized per-generation annotation counters from Annotation.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch_size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        counters.rebuild(batch_size=options['batch_size'])
+        self.stdout.write('Rebuilt {} generation/playlist counters.'.format(
+            AnnotationCount.objects.count()))
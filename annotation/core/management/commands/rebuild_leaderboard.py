@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from core import rankings
+from core.models import LeaderboardEntry
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the materialized leaderboard from Annotation.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch_size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        rankings.rebuild(batch_size=options['batch_size'])
+        self.stdout.write('Rebuilt {} leaderboard entries.'.format(
+            LeaderboardEntry.objects.count()))
@@ -0,0 +1,189 @@
+"""Per-view request metrics, shared across worker processes.
+
+MetricsMiddleware (see core.middleware) times every request and the SQL it
+runs, and TimedDjangoTemplates times template rendering. Each worker adds its
+numbers to in-memory totals and, every FLUSH_INTERVAL seconds, adds them to a
+SQLite file shared by all workers on the host (`settings.METRICS_PATH`). The
+`/metrics` endpoint renders that file in the Prometheus text format.
+"""
+import contextvars
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.template.backends.django import DjangoTemplates, Template
+
+
+# Upper bounds (in seconds) of the request latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+# Seconds between flushes of a worker's totals to the shared store.
+FLUSH_INTERVAL = 5.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metrics (
+    view TEXT NOT NULL,
+    name TEXT NOT NULL,
+    le TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (view, name, le)
+)
+"""
+
+# The RequestMetrics of the request being handled, if any.
+current = contextvars.ContextVar('current_request_metrics', default=None)
+
+
+class RequestMetrics:
+    """What one request spent its time on. Also usable as a database execute
+    wrapper that times every query."""
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.slowest_sql = None
+        self.slowest_sql_seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.queries += 1
+            self.sql_seconds += elapsed
+            if elapsed > self.slowest_sql_seconds:
+                self.slowest_sql, self.slowest_sql_seconds = sql, elapsed
+
+
+class _TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics = current.get()
+            if metrics is not None:
+                metrics.template_seconds += time.perf_counter() - start
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """The Django template backend, timing renders for the current request."""
+
+    def from_string(self, template_code):
+        return _TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return _TimedTemplate(template.template, self)
+
+
+class _Totals:
+    """A worker's metrics that have not been flushed to the store yet."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = defaultdict(float)
+        self.last_flush = time.time()
+
+    def add(self, view, seconds, metrics):
+        with self.lock:
+            for bound in LATENCY_BUCKETS:
+                if seconds <= bound:
+                    self.values[(view, 'latency_bucket', _format_bound(bound))] += 1
+            self.values[(view, 'latency_sum', '')] += seconds
+            self.values[(view, 'requests', '')] += 1
+            self.values[(view, 'sql_queries', '')] += metrics.queries
+            self.values[(view, 'sql_seconds', '')] += metrics.sql_seconds
+            self.values[(view, 'template_seconds', '')] += metrics.template_seconds
+
+    def take(self):
+        with self.lock:
+            values, self.values = self.values, defaultdict(float)
+            self.last_flush = time.time()
+        return values
+
+
+_totals = _Totals()
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def _connect():
+    connection = sqlite3.connect(settings.METRICS_PATH, timeout=10, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(_SCHEMA)
+    return connection
+
+
+def record(view, seconds, metrics):
+    """Adds a finished request to this worker's totals, flushing them to the
+    shared store when they are due."""
+    _totals.add(view, seconds, metrics)
+    if time.time() - _totals.last_flush >= FLUSH_INTERVAL:
+        flush()
+
+
+def flush():
+    """Adds this worker's totals to the shared store."""
+    values = _totals.take()
+    if not values:
+        return
+    connection = _connect()
+    try:
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany(
+                "INSERT INTO metrics (view, name, le, value) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (view, name, le) DO UPDATE SET value = value + excluded.value",
+                [(view, name, le, value) for (view, name, le), value in values.items()])
+    finally:
+        connection.close()
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render():
+    """Returns every worker's metrics in the Prometheus text exposition format."""
+    flush()
+    connection = _connect()
+    try:
+        rows = connection.execute("SELECT view, name, le, value FROM metrics").fetchall()
+    finally:
+        connection.close()
+
+    values = defaultdict(dict)
+    for view, name, le, value in rows:
+        values[name][(view, le)] = value
+
+    lines = [
+        '# HELP roft_request_duration_seconds Request latency by view.',
+        '# TYPE roft_request_duration_seconds histogram',
+    ]
+    for view in sorted(view for view, _ in values['requests']):
+        # Buckets no request has fallen into yet have no row.
+        for bound in LATENCY_BUCKETS:
+            le = _format_bound(bound)
+            lines.append('roft_request_duration_seconds_bucket{{view="{}",le="{}"}} {}'.format(
+                _escape(view), le, values['latency_bucket'].get((view, le), 0.0)))
+    for (view, _), value in sorted(values['latency_sum'].items()):
+        lines.append('roft_request_duration_seconds_sum{{view="{}"}} {}'.format(_escape(view), value))
+    for (view, _), value in sorted(values['requests'].items()):
+        lines.append('roft_request_duration_seconds_count{{view="{}"}} {}'.format(_escape(view), value))
+
+    for name, metric, description in (
+            ('sql_queries', 'roft_sql_queries_total', 'SQL queries run by view.'),
+            ('sql_seconds', 'roft_sql_seconds_total', 'Time spent in SQL by view.'),
+            ('template_seconds', 'roft_template_render_seconds_total',
+             'Time spent rendering templates by view.')):
+        lines.append('# HELP {} {}'.format(metric, description))
+        lines.append('# TYPE {} counter'.format(metric))
+        for (view, _), value in sorted(values[name].items()):
+            lines.append('{}{{view="{}"}} {}'.format(metric, _escape(view), value))
+    return '\n'.join(lines) + '\n'
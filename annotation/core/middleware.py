@@ -0,0 +1,63 @@
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from core import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class _QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class QueryCountMiddleware:
+    """Reports how many SQL queries a request ran in an X-Query-Count header.
+    Enabled with the QUERY_COUNT_HEADER setting and read by `manage.py load_test`."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        counter = _QueryCounter()
+        with connection.execute_wrapper(counter):
+            response = self.get_response(request)
+        response['X-Query-Count'] = str(counter.count)
+        return response
+
+
+class MetricsMiddleware:
+    """Records latency, SQL and template render time per view in core.metrics,
+    and logs requests whose slowest query exceeds SLOW_QUERY_SECONDS. Enabled
+    with the METRICS setting."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request_metrics = metrics.RequestMetrics()
+        token = metrics.current.set(request_metrics)
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(request_metrics):
+                response = self.get_response(request)
+        finally:
+            metrics.current.reset(token)
+        elapsed = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.url_name if match and match.url_name else 'unmatched'
+        metrics.record(view, elapsed, request_metrics)
+        if request_metrics.queries and request_metrics.slowest_sql_seconds >= settings.SLOW_QUERY_SECONDS:
+            logger.warning("Slow query in %s (%.3fs of %d queries, %.3fs total): %s",
+                           view, request_metrics.slowest_sql_seconds, request_metrics.queries,
+                           request_metrics.sql_seconds, request_metrics.slowest_sql)
+        return response
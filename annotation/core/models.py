@@ -2,6 +2,8 @@ import uuid
 from django.db import models
 from django.contrib.auth.models import User
 
+from core import timestamps
+
 
 SEP = "_SEP_"
 
@@ -65,11 +67,16 @@ class Generation(models.Model):
     decoding_strategy = models.ForeignKey(
         DecodingStrategy, on_delete=models.DO_NOTHING)
     body = models.TextField()
-
-    @property
-    def boundary(self):
-        # TODO(daphne): Should there be a +1 here?
-        return self.prompt.num_sentences - 1
+    # Denormalized count of Annotations on this generation, kept up to date by
+    # core.counters and rebuilt with `manage.py rebuild_annotation_counts`.
+    num_annotations = models.IntegerField(default=0, db_index=True)
+    # JSON the annotate page is rendered from, precomputed by core.payloads.
+    payload = models.TextField(blank=True, default='')
+    payload_version = models.IntegerField(default=0)
+    # Index of the last human-written sentence, i.e. prompt.num_sentences - 1,
+    # stored by core.boundaries so correctness can be computed without the Prompt.
+    # TODO(daphne): Should there be a +1 here?
+    boundary = models.IntegerField(null=True, db_index=True)
 
     def __str__(self):
         return self.body
@@ -88,6 +95,9 @@ class FeedbackOption(models.Model):
 
 class Annotation(models.Model):
     """A human annotation of a prompt-continuation pair."""
+    class Meta:
+        indexes = [models.Index(fields=["annotator", "attention_check", "is_correct"])]
+
     date = models.DateTimeField(auto_now=True, null=True)
     annotator = models.ForeignKey(User, on_delete=models.DO_NOTHING)
     generation = models.ForeignKey(Generation, on_delete=models.DO_NOTHING)
@@ -96,14 +106,64 @@ class Annotation(models.Model):
     points = models.IntegerField()
     reason = models.ManyToManyField(FeedbackOption)
     attention_check = models.BooleanField(default=False)
+    # Idempotency key of the submission that created this annotation.
+    submission_key = models.CharField(max_length=64, null=True, unique=True)
+    # How many sentences after the generation's boundary the annotator guessed
+    # (negative if before it) and whether they guessed it exactly, written by
+    # core.boundaries when the annotation is saved.
+    distance = models.IntegerField(null=True)
+    is_correct = models.BooleanField(null=True)
+    # Button-press timestamps, delta-encoded by core.timestamps. NULL for
+    # annotations whose timestamps are still stored as Timestamp rows.
+    packed_timestamps = models.BinaryField(null=True)
+
+    def timestamp_dates(self):
+        """Yields when each button of this annotation was pressed, as datetimes."""
+        return timestamps.dates(self)
 
     def __str__(self):
         return self.annotator.username + " " + str(self.date)
 
 
+class AnnotationCount(models.Model):
+    """Denormalized count of the Annotations a Generation received in a playlist."""
+    class Meta:
+        unique_together = (("generation", "playlist"),)
+
+    generation = models.ForeignKey(Generation, on_delete=models.DO_NOTHING)
+    # Matches Annotation.playlist.
+    playlist = models.CharField(max_length=30, default='', db_index=True)
+    count = models.IntegerField(default=0)
+
+
+class Lease(models.Model):
+    """A time-limited reservation of a Generation for the annotator it was served to.
+    Released when the annotation is saved, ignored once it expires."""
+    class Meta:
+        unique_together = (("annotator", "generation"),)
+        indexes = [models.Index(fields=["generation", "expires"])]
+
+    annotator = models.ForeignKey(User, on_delete=models.DO_NOTHING)
+    generation = models.ForeignKey(Generation, on_delete=models.DO_NOTHING)
+    expires = models.DateTimeField(db_index=True)
+
+
+class LeaderboardEntry(models.Model):
+    """A user's running point total, maintained incrementally by core.rankings."""
+    class Meta:
+        indexes = [models.Index(fields=["is_listed", "points"])]
+
+    user = models.OneToOneField(User, on_delete=models.DO_NOTHING, primary_key=True)
+    points = models.IntegerField(default=0)
+    # Only signed-up, active users with a usable password are shown.
+    is_listed = models.BooleanField(default=False)
+
+
 class Timestamp(models.Model):
     """When a continuation/decision was made. First Timestamp is annotation start,
-    last is annotation submit, and in-between are for different continuations."""
+    last is annotation submit, and in-between are for different continuations.
+    Only kept for annotations saved before timestamps were packed onto
+    Annotation; read them through `Annotation.timestamp_dates()`."""
     annotation = models.ForeignKey(Annotation, on_delete=models.DO_NOTHING)
     date = models.DateTimeField()
 
@@ -119,11 +179,25 @@ class Playlist(models.Model):
     details = models.TextField(blank=True)
     generations = models.ManyToManyField(Generation)
     version = models.CharField(max_length=8)
+    # Fingerprint of the generations files the playlist was last loaded from
+    # by populate_database.py, which skips the playlist while it is unchanged.
+    sources_fingerprint = models.CharField(max_length=64, blank=True, default='')
 
     def __str__(self):
         return self.name
 
 
+class LoadedSource(models.Model):
+    """The load manifest of populate_database.py: a generations file that was
+    loaded, identified by the fingerprint of its content and of the loader
+    settings, with the generations it yielded. A file with the same
+    fingerprint is not parsed or checked row by row again."""
+    fingerprint = models.CharField(max_length=64, unique=True)
+    location = models.TextField()
+    loaded = models.DateTimeField(auto_now=True)
+    generations = models.ManyToManyField(Generation)
+
+
 # deprecated
 class Tag(models.Model):
     name = models.CharField(max_length=100)
@@ -0,0 +1,79 @@
+"""Precomputed display payloads for the annotate page.
+
+Splitting a prompt and its continuation on SEP, escaping newlines and
+serializing the sentences only depends on the Generation and its Prompt, so it
+is done once (when the generation is loaded, or the first time it is served)
+and stored on `Generation.payload`. Serving an example then needs neither
+string processing nor a Prompt fetch.
+
+`Generation.payload_version` records which PAYLOAD_VERSION built the payload;
+bump PAYLOAD_VERSION whenever `build()` changes and stale payloads are rebuilt
+as they are served, or all at once with `manage.py build_payloads`.
+"""
+import json
+
+from core.models import Generation, SEP
+
+
+PAYLOAD_VERSION = 1
+# The most sentences shown for a single example.
+MAX_SENTENCES = 9
+
+
+def build(prompt_body, num_sentences, generation_body):
+    """Returns the payload for a generation as a dict."""
+    prompt_sentences = prompt_body.split(SEP)
+    generated_sentences = generation_body.split(SEP)
+    continuation_sentences = (prompt_sentences[1:] + generated_sentences)[:MAX_SENTENCES]
+    boundary = num_sentences - 1
+
+    return {
+        # For some datasets, most importntly recipes, the first sentence of the prompt might
+        # have new lines in it which are critical to understanding.
+        'prompt': prompt_sentences[0].replace("\n", "<br/>"),
+        'sentences': json.dumps(continuation_sentences),
+        'max_sentences': len(continuation_sentences),
+        'boundary': boundary,
+        'all_human': boundary == len(generated_sentences),
+    }
+
+
+def serialize(prompt_body, num_sentences, generation_body):
+    """Returns the fields to store on a Generation for the given texts."""
+    return {
+        'payload': json.dumps(build(prompt_body, num_sentences, generation_body)),
+        'payload_version': PAYLOAD_VERSION,
+    }
+
+
+def get(generation):
+    """Returns the payload of `generation`, rebuilding it if it is stale."""
+    if generation.payload_version == PAYLOAD_VERSION and generation.payload:
+        return json.loads(generation.payload)
+
+    prompt = generation.prompt
+    fields = serialize(prompt.body, prompt.num_sentences, generation.body)
+    Generation.objects.filter(pk=generation.pk).update(**fields)
+    generation.payload, generation.payload_version = fields['payload'], fields['payload_version']
+    return json.loads(generation.payload)
+
+
+def rebuild(batch_size=1000, force=False):
+    """Rebuilds stale payloads (or all of them with `force`) and returns how many were built."""
+    generations = Generation.objects.select_related('prompt').order_by('pk')
+    if not force:
+        generations = generations.exclude(payload_version=PAYLOAD_VERSION)
+
+    built, last_pk = 0, 0
+    while True:
+        # Page by primary key rather than holding a cursor open on the table being updated.
+        batch = list(generations.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            return built
+        for generation in batch:
+            fields = serialize(generation.prompt.body, generation.prompt.num_sentences, generation.body)
+            generation.payload = fields['payload']
+            generation.payload_version = fields['payload_version']
+        Generation.objects.bulk_update(batch, ['payload', 'payload_version'])
+        built += len(batch)
+        last_pk = batch[-1].pk
@@ -0,0 +1,56 @@
+"""The playlists shown on the play page, with their sizes and rendered markdown.
+
+Playlists only change when `populate_database.py` is run, so the whole listing
+is built with one annotated COUNT query, plus one over the per-playlist
+annotation counters (`AnnotationCount`, see core.counters), and kept in the
+shared cache (see core.caching); populate_database.py invalidates it when it
+finishes. Annotation totals are therefore up to _CACHE_TIMEOUT old. Rendered
+markdown is also memoized by content in each worker, so rebuilding the listing
+only renders descriptions that changed.
+"""
+import functools
+
+from django.db.models import Count, Sum
+from markdown2 import markdown
+
+from core import caching
+from core.models import AnnotationCount, Playlist
+
+
+_CACHE_KEY = 'playlists:listing:{}'
+# The listing is rebuilt at least this often (in seconds).
+_CACHE_TIMEOUT = 60 * 60
+
+
+@functools.lru_cache(maxsize=256)
+def _markdown(text):
+    return markdown(text)
+
+
+def _build(version):
+    playlists = list(Playlist.objects.filter(version=version).annotate(
+        size=Count('generations')).order_by('pk'))
+    # Annotation.playlist holds the playlist id as a string.
+    annotations = dict(AnnotationCount.objects.filter(
+        playlist__in=[str(playlist.pk) for playlist in playlists]
+    ).order_by().values('playlist').annotate(total=Sum('count')).values_list('playlist', 'total'))
+    return [{
+        'id': playlist.pk,
+        'shortname': playlist.shortname,
+        'name': playlist.name,
+        'description': _markdown(playlist.description),
+        'details': _markdown(playlist.details),
+        'size': playlist.size,
+        'annotations': annotations.get(str(playlist.pk), 0),
+    } for playlist in playlists]
+
+
+def listing(version):
+    """Returns the playlists of `version` as dicts with their rendered
+    `description` and `details`, their number of generations as `size` and
+    their number of annotations as `annotations`."""
+    return caching.get(_CACHE_KEY.format(version), lambda: _build(version), _CACHE_TIMEOUT)
+
+
+def invalidate(version):
+    caching.invalidate(_CACHE_KEY.format(version))
@@ -0,0 +1,35 @@
+"""The requesting user's Profile, loaded at most once per request.
+
+Views call `get(request)` and templates get it as `profile` through the
+`context` processor (see TEMPLATES in settings); both share the Profile cached
+on the request, whose `user` is the User the authentication middleware already
+loaded.
+"""
+from core.models import Profile
+
+
+def get(request):
+    """Returns the Profile of the requesting user, or None for an anonymous
+    visitor (or a user without one)."""
+    try:
+        return request._profile
+    except AttributeError:
+        pass
+
+    profile = None
+    if request.user.is_authenticated:
+        profile = Profile.objects.filter(user=request.user).first()
+        if profile is not None:
+            profile.user = request.user
+    request._profile = profile
+    return profile
+
+
+def remember(request, profile):
+    """Caches `profile` as the requesting user's, e.g. after logging a new user in."""
+    request._profile = profile
+
+
+def context(request):
+    """Template context processor adding the requesting user's `profile`."""
+    return {'profile': get(request)}
@@ -0,0 +1,125 @@
+"""The materialized leaderboard.
+
+Every user with annotations has a LeaderboardEntry holding their point total.
+Saving annotations increments it, so reading the top of the leaderboard is a
+walk down the (is_listed, points) index and a user's rank is a range count on
+that same index, whatever their position.
+
+The top of the leaderboard is also cached for every worker (see core.caching).
+It is invalidated when listings change, and when saved points could change
+the cached top, i.e. when the new total reaches its lowest score. Other saves
+rely on the cache's TTL.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q, Sum
+
+from core import caching
+from core.models import Annotation, LeaderboardEntry, Profile
+
+
+# The number of users shown on the leaderboard page.
+LEADERBOARD_SIZE = 50
+_CACHE_KEY = 'leaderboard:top'
+# The cached top is recomputed at least this often (in seconds).
+_CACHE_TIMEOUT = 60
+
+
+def _listed_profiles():
+    # Only include profiles of valid, signed in users. This is equivalent to
+    # checking that has_usable_password is set to True for each user.
+    return Profile.objects.filter(
+        Q(is_temporary=False) &
+        Q(user__is_active=True) &
+        Q(user__password__isnull=False) &
+        ~Q(user__password__startswith='!'))
+
+
+def _is_listed(user_id):
+    return _listed_profiles().filter(user_id=user_id).exists()
+
+
+def add_points(user_id, points):
+    """Adds `points` to the total of `user_id`. Should be called inside the
+    transaction that creates the annotations."""
+    updated = LeaderboardEntry.objects.filter(user_id=user_id).update(
+        points=F('points') + points)
+    if not updated:
+        _create_entry(user_id, points)
+    if _changes_cached_top(user_id, points):
+        transaction.on_commit(invalidate)
+
+
+def _create_entry(user_id, points):
+    try:
+        with transaction.atomic():
+            LeaderboardEntry.objects.create(
+                user_id=user_id, points=points, is_listed=_is_listed(user_id))
+    except IntegrityError:
+        # A concurrent save created the entry first.
+        LeaderboardEntry.objects.filter(user_id=user_id).update(points=F('points') + points)
+
+
+def _changes_cached_top(user_id, points):
+    """Returns whether `user_id` having gained `points` may change the cached top."""
+    if not points:
+        return False
+    cached = caching.peek(_CACHE_KEY)
+    if cached is None:
+        # The next read computes it anyway.
+        return False
+    if len(cached) < LEADERBOARD_SIZE:
+        return True
+    total = LeaderboardEntry.objects.filter(
+        user_id=user_id, is_listed=True).values_list('points', flat=True).first()
+    return total is not None and total >= cached[-1][1]
+
+
+def update_listing(user_id):
+    """Re-evaluates whether `user_id` should be shown, e.g. after signing up."""
+    LeaderboardEntry.objects.filter(user_id=user_id).update(is_listed=_is_listed(user_id))
+    transaction.on_commit(invalidate)
+
+
+def top(limit=50):
+    """Returns the top `limit` listed users as (username, points) pairs."""
+    entries = LeaderboardEntry.objects.filter(is_listed=True, points__gt=0)
+    entries = entries.order_by('-points', 'user_id').values_list('user__username', 'points')
+    return list(entries[:limit])
+
+
+def cached_top():
+    """Returns the top LEADERBOARD_SIZE listed users, as `top()` does, from the shared cache."""
+    return caching.get(_CACHE_KEY, lambda: top(LEADERBOARD_SIZE), _CACHE_TIMEOUT)
+
+
+def invalidate():
+    caching.invalidate(_CACHE_KEY)
+
+
+def rank(user):
+    """Returns the 1-based leaderboard position of `user`, or -1 if they are not on it."""
+    entry = LeaderboardEntry.objects.filter(
+        user_id=user.id, is_listed=True, points__gt=0).values_list('points', flat=True).first()
+    if entry is None:
+        return -1
+    return LeaderboardEntry.objects.filter(is_listed=True, points__gt=entry).count() + 1
+
+
+def rebuild(batch_size=1000):
+    """Recomputes every LeaderboardEntry from the Annotation table."""
+    listed = set(_listed_profiles().values_list('user_id', flat=True))
+    totals = Annotation.objects.order_by().values('annotator').annotate(points=Sum('points'))
+
+    with transaction.atomic():
+        LeaderboardEntry.objects.all().delete()
+        batch = []
+        for row in totals.iterator():
+            batch.append(LeaderboardEntry(
+                user_id=row['annotator'],
+                points=row['points'] or 0,
+                is_listed=row['annotator'] in listed))
+            if len(batch) >= batch_size:
+                LeaderboardEntry.objects.bulk_create(batch)
+                batch = []
+        LeaderboardEntry.objects.bulk_create(batch)
+        transaction.on_commit(invalidate)
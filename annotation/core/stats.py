@@ -0,0 +1,65 @@
+"""Per-user annotation statistics shown on the profile page."""
+from collections import defaultdict
+
+from django.db.models import Avg, Count, F, Q, Sum
+
+from core import caching
+from core.models import Annotation, Generation
+
+
+_CACHE_KEY = 'profile_stats:{}'
+# Cached stats are recomputed at least this often (in seconds).
+_CACHE_TIMEOUT = 15 * 60
+
+
+def _in_playlist(playlist_name):
+    if not playlist_name:
+        return None
+    # Find all annotations in the correct playlist.
+    return Q(generation__in=Generation.objects.filter(playlist__shortname=playlist_name))
+
+
+def _and(condition, other):
+    return other if condition is None else condition & other
+
+
+def build_counts(user, playlists, attention_check=False):
+    """Returns stats about the specified user's performance on each playlist.
+
+    `playlists` maps a key in the returned dict to a playlist shortname, or to
+    None for stats across all playlists. Everything is computed with a single
+    conditional-aggregation query over the user's annotations, using their
+    stored `is_correct` and `distance` (see core.boundaries).
+    """
+    correct = Q(is_correct=True)
+    past_boundary = Q(distance__gt=0)
+    distance = F('distance')
+
+    aggregates = {}
+    for key, playlist_name in playlists.items():
+        in_playlist = _in_playlist(playlist_name)
+        aggregates[key + '__points'] = Sum('points', filter=in_playlist)
+        aggregates[key + '__total'] = Count('pk', filter=in_playlist)
+        aggregates[key + '__correct'] = Count('pk', filter=_and(in_playlist, correct))
+        aggregates[key + '__past_boundary'] = Count('pk', filter=_and(in_playlist, past_boundary))
+        aggregates[key + '__avg_distance'] = Avg(distance, filter=in_playlist)
+
+    user_annotations = Annotation.objects.filter(annotator=user, attention_check=attention_check)
+    results = user_annotations.aggregate(**aggregates)
+
+    counts = {key: defaultdict(int) for key in playlists}
+    for name, value in results.items():
+        key, stat = name.split('__')
+        counts[key][stat] = value
+    return counts
+
+
+def cached_counts(user, playlists):
+    """Returns `build_counts(user, playlists)` from the shared cache. Every
+    caller must pass the same `playlists`, since the key only depends on the user."""
+    return caching.get(
+        _CACHE_KEY.format(user.pk), lambda: build_counts(user, playlists), _CACHE_TIMEOUT)
+
+
+def invalidate(user_id):
+    caching.invalidate(_CACHE_KEY.format(user_id))
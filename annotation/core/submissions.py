@@ -0,0 +1,148 @@
+"""The write path for annotation submissions.
+
+A submission is parsed once into a plain dict and then written with a fixed
+number of statements inside one transaction: one insert per annotation (which
+carries its packed timestamps, see core.timestamps), a single bulk insert into
+the reason through-table, and the counter, leaderboard and lease bookkeeping. Cached
+leaderboard and profile stats are invalidated once the transaction commits. The number of
+queries does not depend on how many timestamps or reasons a submission has.
+"""
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+
+from core import assignment, boundaries, counters, feedback, journal, rankings, stats, timestamps
+from core.models import Annotation, FeedbackOption, Generation
+
+
+# Matches the length of Annotation.submission_key.
+KEY_LENGTH = 64
+
+
+def _key(key):
+    """Returns the idempotency key sent by the client, or a new one."""
+    if not key:
+        return uuid.uuid4().hex
+    key = str(key)
+    if len(key) > KEY_LENGTH:
+        raise ValueError("Submission key is too long.")
+    return key
+
+
+def parse(data):
+    """Builds a submission from the POST data sent by annotate.html."""
+    timestamps = [int(t) for t in data.get('timestamps', '').split(',') if t]
+    reasons = [option.shortname for option in feedback.default_options()
+               if data.get(option.shortname) == 'true']
+    return {
+        'key': _key(data.get('key')),
+        'generation_id': int(data['text']),
+        'playlist': str(data.get('playlist_id', '')),
+        'boundary': int(data['boundary']),
+        'points': int(data['points']),
+        'attention_check': bool(int(data.get('attention_check', 0))),
+        'timestamps': timestamps,
+        'reasons': reasons,
+        'other_reason': data.get('other_reason', ''),
+    }
+
+
+def parse_json(item):
+    """Builds a submission from one item of a JSON submit request."""
+    if not isinstance(item, dict):
+        raise ValueError("A submission must be an object.")
+    default_reasons = {option.shortname for option in feedback.default_options()}
+    return {
+        'key': _key(item.get('key')),
+        'generation_id': int(item['text']),
+        'playlist': str(item.get('playlist_id', '')),
+        'boundary': int(item['boundary']),
+        'points': int(item['points']),
+        'attention_check': bool(int(item.get('attention_check', 0))),
+        'timestamps': [int(t) for t in item.get('timestamps', [])],
+        'reasons': sorted(set(item.get('reasons', [])) & default_reasons),
+        'other_reason': item.get('other_reason') or '',
+    }
+
+
+def parse_batch(items):
+    """Builds the submissions of a JSON submit request. Raises ValueError if the
+    batch is empty, or an item is malformed or names a generation that does not
+    exist, so nothing is accepted from a batch that cannot be written in full."""
+    if not isinstance(items, list) or not items:
+        raise ValueError("Submissions must be a non-empty list.")
+    parsed = [parse_json(item) for item in items]
+    generation_ids = {submission['generation_id'] for submission in parsed}
+    if Generation.objects.filter(pk__in=generation_ids).count() != len(generation_ids):
+        raise ValueError("Unknown generation.")
+    return parsed
+
+
+def _other_reason_option(other_reason):
+    return FeedbackOption(
+        shortname=str(hash(other_reason)),
+        category="other",
+        description=other_reason,
+        is_default=False)
+
+
+def accept(user_id, parsed):
+    """Saves parsed submissions, either directly or through the write-behind
+    journal when `settings.ANNOTATION_WRITE_BEHIND` is on."""
+    if settings.ANNOTATION_WRITE_BEHIND:
+        journal.append(user_id, parsed)
+    else:
+        record(user_id, parsed)
+
+
+def record(user_id, submissions):
+    """Writes the given submissions for `user_id` and returns the new Annotations.
+    Submissions whose key was already saved are skipped."""
+    with transaction.atomic():
+        saved = set(Annotation.objects.filter(
+            submission_key__in=[submission['key'] for submission in submissions]
+        ).values_list('submission_key', flat=True))
+        submissions = [submission for submission in submissions if submission['key'] not in saved]
+        if not submissions:
+            return []
+
+        true_boundaries = boundaries.of(
+            [submission['generation_id'] for submission in submissions])
+        annotations = [
+            Annotation.objects.create(
+                annotator_id=user_id,
+                submission_key=submission['key'],
+                generation_id=submission['generation_id'],
+                playlist=submission['playlist'],
+                boundary=submission['boundary'],
+                points=submission['points'],
+                attention_check=submission['attention_check'],
+                packed_timestamps=timestamps.pack(submission['timestamps']),
+                **boundaries.score(
+                    submission['boundary'], true_boundaries[submission['generation_id']]))
+            for submission in submissions]
+
+        reasons, other_options = [], []
+        Reason = Annotation.reason.through
+        for annotation, submission in zip(annotations, submissions):
+            reasons.extend(
+                Reason(annotation_id=annotation.pk, feedbackoption_id=shortname)
+                for shortname in submission['reasons'])
+            if submission['other_reason']:
+                option = _other_reason_option(submission['other_reason'])
+                other_options.append(option)
+                reasons.append(Reason(annotation_id=annotation.pk, feedbackoption_id=option.shortname))
+
+        if other_options:
+            # The same free-text reason may have been submitted before.
+            FeedbackOption.objects.bulk_create(other_options, ignore_conflicts=True)
+        if reasons:
+            Reason.objects.bulk_create(reasons)
+
+        counters.add_annotations(
+            (submission['generation_id'], submission['playlist']) for submission in submissions)
+        rankings.add_points(user_id, sum(submission['points'] for submission in submissions))
+        assignment.release(user_id, [submission['generation_id'] for submission in submissions])
+        transaction.on_commit(lambda: stats.invalidate(user_id))
+    return annotations
@@ -0,0 +1,38 @@
+"""Temporary users for visitors who have not signed up.
+
+Visitors can land on the site and start annotating without an account; until
+then their progress lives in the session. The User and Profile rows of a
+temporary user are only created when the visitor first saves an annotation
+(see `ensure_user`), so bounce traffic and crawlers never touch the auth
+tables. Temporary usernames are random UUIDs, so allocating one needs no
+round trip to check for collisions.
+"""
+import uuid
+
+from django.contrib.auth import login
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from core import profiles
+from core.models import Profile
+
+
+def temporary_username():
+    """Returns a new username for a temporary user, e.g. 3f2a-91c0-...-7b1e."""
+    name = uuid.uuid4().hex
+    return '-'.join(name[start:start + 4] for start in range(0, len(name), 4))
+
+
+def ensure_user(request):
+    """Returns the user making `request`, first creating and logging in a
+    temporary user if the visitor is anonymous. Session data is kept."""
+    if request.user.is_authenticated:
+        return request.user
+
+    with transaction.atomic():
+        user = User.objects.create(username=temporary_username(), password=make_password(None))
+        profile = Profile.objects.create(user=user, is_temporary=True)
+    login(request, user)
+    profiles.remember(request, profile)
+    return user
@@ -1,19 +1,28 @@
-import sys
+import urllib.parse
 import urllib.request
+import hashlib
+import itertools
 import json
 import os
 import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import django
 import requests
 import click
 import csv
-from django.db import IntegrityError
+import time
+from django.db import transaction
+
+from core import jsonstream
 
 # kirubarajan: django model imports at bottom since you have to configure
 # the environment first
 
 MIN_LENGTH = 10
 P_VALUES_TO_KEEP = [0.0, 0.4, 1.0]
+# Seconds to wait for a generations file server to respond.
+FETCH_TIMEOUT = 60
 
 # helper function to fix malformatted JSON
 
@@ -31,6 +40,65 @@ def _read_json(f):
     return json.loads(_clean_json(text))
 
 
+def _sha256(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _fetch(location, cache_dir):
+    """Returns the path of a local copy of the generations file at `location`.
+
+    Local files (`file://` URLs or plain paths) are read in place. Other URLs
+    are downloaded into `cache_dir`, which stores each file under the SHA-256
+    of its content (`objects/`) and, for each URL, the ETag and hash of its
+    last download (`urls/`). A cached URL is only downloaded again if the
+    server no longer answers 304 Not Modified to its ETag, and its cached copy
+    is used if the server cannot be reached.
+    """
+    scheme = urllib.parse.urlparse(location).scheme
+    if scheme == "file":
+        return urllib.request.url2pathname(urllib.parse.urlparse(location).path)
+    if scheme not in ("http", "https"):
+        return location
+
+    objects_dir = os.path.join(cache_dir, "objects")
+    index_path = os.path.join(cache_dir, "urls", _sha256(location) + ".json")
+    os.makedirs(objects_dir, exist_ok=True)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+
+    cached = None
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            cached = json.load(f)
+        if not os.path.exists(os.path.join(objects_dir, cached["sha256"])):
+            cached = None
+    headers = {"If-None-Match": cached["etag"]} if cached and cached["etag"] else {}
+
+    try:
+        response = requests.get(location, headers=headers, stream=True, timeout=FETCH_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        if cached is None:
+            raise
+        print("Could not fetch {} ({}), using the cached copy.".format(location, e))
+        return os.path.join(objects_dir, cached["sha256"])
+    if response.status_code == 304:
+        return os.path.join(objects_dir, cached["sha256"])
+
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=objects_dir, delete=False) as f:
+        for chunk in response.iter_content(chunk_size=1 << 20):
+            digest.update(chunk)
+            f.write(chunk)
+    path = os.path.join(objects_dir, digest.hexdigest())
+    os.replace(f.name, path)
+
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(index_path), delete=False) as f:
+        json.dump({"url": location, "etag": response.headers.get("ETag"),
+                   "sha256": digest.hexdigest()}, f)
+    os.replace(f.name, index_path)
+    return path
+
+
 def _try_create_feedback_option(shortname, category, description):
     feedback_option = FeedbackOption.objects.filter(shortname=shortname)
     if not feedback_option:
@@ -118,14 +186,193 @@ def _try_create_generation(gen_text, system, prompt, decoding_strategy):
             body=gen_text,
             system=system,
             prompt=prompt,
-            decoding_strategy=decoding_strategy)
+            decoding_strategy=decoding_strategy,
+            boundary=boundaries.true_boundary(prompt.num_sentences),
+            **payloads.serialize(prompt.body, prompt.num_sentences, gen_text))
     return gen
 
 
+def _read_generations(path):
+    """Returns the fields of the generations file at `path` other than
+    "generations", and an iterator that parses its "generations" records one
+    at a time, so that the file is never held in memory as a whole."""
+    with open(path, "rb") as f:
+        stream = jsonstream.JsonStream(f)
+        fields = {}
+        for key in stream.keys():
+            if key == "generations":
+                stream.skip()
+            else:
+                fields[key] = stream.value()
+
+    def generations():
+        with open(path, "rb") as f:
+            stream = jsonstream.JsonStream(f)
+            for key in stream.keys():
+                if key == "generations":
+                    yield from stream.array()
+                else:
+                    stream.skip()
+
+    return fields, generations()
+
+
+def _fingerprint(path):
+    """Returns the manifest fingerprint of the generations file at `path`:
+    a hash of its content and of the settings that decide which of its
+    generations are loaded."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return _sha256(json.dumps([digest.hexdigest(), MIN_LENGTH, P_VALUES_TO_KEEP]))
+
+
+def _record_source(location, fingerprint, generation_ids, chunk_size):
+    """Adds the generations file `location` to the load manifest."""
+    with transaction.atomic():
+        source, _ = LoadedSource.objects.update_or_create(
+            fingerprint=fingerprint, defaults={"location": location})
+        source.generations.clear()
+        SourceGeneration = LoadedSource.generations.through
+        for chunk in _chunks(dict.fromkeys(generation_ids), chunk_size):
+            SourceGeneration.objects.bulk_create([
+                SourceGeneration(loadedsource_id=source.pk, generation_id=generation_id)
+                for generation_id in chunk])
+
+
+def _reconcile_playlist(playlist, generation_ids, chunk_size, remove=True):
+    """Makes `generation_ids` the generations of `playlist`, inserting and
+    deleting only the difference. Returns the numbers added and removed.
+    With `remove=False` the playlist only gains generations."""
+    PlaylistGeneration = Playlist.generations.through
+    current = set(PlaylistGeneration.objects.filter(
+        playlist_id=playlist.pk).values_list("generation_id", flat=True))
+    added = sorted(generation_ids - current)
+    removed = sorted(current - generation_ids) if remove else []
+    for chunk in _chunks(added, chunk_size):
+        PlaylistGeneration.objects.bulk_create([
+            PlaylistGeneration(playlist_id=playlist.pk, generation_id=generation_id)
+            for generation_id in chunk])
+    for chunk in _chunks(removed, chunk_size):
+        PlaylistGeneration.objects.filter(
+            playlist_id=playlist.pk, generation_id__in=chunk).delete()
+    return len(added), len(removed)
+
+
+def _chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _bulk_load_chunk(rows, system, dataset, strategies):
+    """Loads one chunk of generation records. Returns the number of prompts
+    and generations created and the ids of the generations of the records
+    that were kept, one per record."""
+    # As in the per-generation loop, a prompt is created for every generation
+    # that is long enough, even if its decoding strategy is skipped.
+    rows = [row for row in rows if len(row["prompt"]) + len(row["generation"]) >= MIN_LENGTH]
+
+    prompts = {}
+    indexes = list(dict.fromkeys(int(row["prompt-index"]) for row in rows))
+    for prompt in Prompt.objects.filter(dataset=dataset, prompt_index__in=indexes):
+        prompts[prompt.prompt_index] = prompt
+
+    new_prompts = {}
+    for row in rows:
+        index = int(row["prompt-index"])
+        if index not in prompts and index not in new_prompts:
+            new_prompts[index] = Prompt(
+                prompt_index=index,
+                dataset=dataset,
+                body=SEP.join(row["prompt"]),
+                num_sentences=len(row["prompt"]))
+    if new_prompts:
+        Prompt.objects.bulk_create(new_prompts.values())
+        # Not every backend returns the primary keys of bulk inserted rows.
+        for prompt in Prompt.objects.filter(dataset=dataset, prompt_index__in=list(new_prompts)):
+            prompts[prompt.prompt_index] = prompt
+
+    rows = [row for row in rows if row["p"] in P_VALUES_TO_KEEP]
+    for p in dict.fromkeys(row["p"] for row in rows):
+        if p not in strategies:
+            strategies[p] = _try_create_decoding_strategy("top-p", p)
+
+    def key(row):
+        return prompts[int(row["prompt-index"])].pk, strategies[row["p"]].pk
+
+    def resolve(prompt_ids):
+        for pk, prompt_id, strategy_id in Generation.objects.filter(
+                system=system, prompt_id__in=prompt_ids).order_by('pk').values_list(
+                    'pk', 'prompt_id', 'decoding_strategy_id'):
+            generation_ids.setdefault((prompt_id, strategy_id), pk)
+
+    generation_ids = {}
+    resolve(list(dict.fromkeys(key(row)[0] for row in rows)))
+
+    new_generations = {}
+    for row in rows:
+        if key(row) not in generation_ids and key(row) not in new_generations:
+            prompt = prompts[int(row["prompt-index"])]
+            gen_text = SEP.join(row["generation"])
+            new_generations[key(row)] = Generation(
+                body=gen_text,
+                system=system,
+                prompt=prompt,
+                decoding_strategy=strategies[row["p"]],
+                boundary=boundaries.true_boundary(prompt.num_sentences),
+                **payloads.serialize(prompt.body, prompt.num_sentences, gen_text))
+    if new_generations:
+        Generation.objects.bulk_create(new_generations.values())
+        resolve(list(dict.fromkeys(prompt_id for prompt_id, _ in new_generations)))
+
+    return len(new_prompts), len(new_generations), [generation_ids[key(row)] for row in rows]
+
+
+def _bulk_load_generations(generations, system, dataset, chunk_size):
+    """Loads the generation records of one file with the same result as the
+    per-generation loop in `populate_db`, `chunk_size` records at a time:
+    existing prompts and generations are resolved with a query per chunk and
+    the missing ones are inserted with bulk_create, one transaction per chunk.
+    Returns the ids of the generations of the records that were kept."""
+    start = time.time()
+    strategies = {}
+    records, prompt_count, generation_count, kept = 0, 0, 0, []
+    for chunk in _chunks(generations, chunk_size):
+        with transaction.atomic():
+            created_prompts, created_generations, chunk_kept = _bulk_load_chunk(
+                chunk, system, dataset, strategies)
+        records += len(chunk)
+        prompt_count += created_prompts
+        generation_count += created_generations
+        kept.extend(chunk_kept)
+
+    elapsed = time.time() - start
+    print("Kept {} of {} records, creating {} prompts and {} generations, in {:.1f}s "
+          "({:.0f} records/s).".format(
+              len(kept), records, prompt_count, generation_count, elapsed,
+              records / elapsed if elapsed else 0))
+    return kept
+
+
 @click.command()
 @click.option('--generations_path', help='JSON file containing generations.')
 @click.option('--version', help='Version number.')
-def populate_db(generations_path, version):
+@click.option('--bulk', is_flag=True,
+              help='Load each generations file with bulk inserts instead of one query per row.')
+@click.option('--chunk_size', default=500,
+              help='Generation records loaded per transaction with --bulk.')
+@click.option('--cache_dir', default='.generations_cache',
+              help='Directory in which downloaded generations files are cached.')
+@click.option('--fetch_workers', default=8,
+              help='Generations files downloaded at the same time.')
+@click.option('--full', is_flag=True,
+              help='Load every generations file again, ignoring the load manifest.')
+def populate_db(generations_path, version, bulk, chunk_size, cache_dir, fetch_workers, full):
     # populate pre-set feedback options
     with open('feedback_default_options.csv') as csv_file:
         csv_reader = csv.reader(csv_file, delimiter=',')
@@ -146,6 +393,13 @@ def populate_db(generations_path, version):
         playlists_json = _read_json(file)
     click.echo("Finished loading.")
 
+    # Download every generations file up front, a few at a time; each one is
+    # loaded as soon as its download finishes.
+    locations = dict.fromkeys(
+        location for playlist_json in playlists_json for location in playlist_json["locations"])
+    executor = ThreadPoolExecutor(max_workers=fetch_workers)
+    downloads = {location: executor.submit(_fetch, location, cache_dir) for location in locations}
+
     for playlist_json in playlists_json:
         # creating playlist
         playlist = _try_create_playlist(
@@ -157,11 +411,32 @@ def populate_db(generations_path, version):
             details=playlist_json["details"]
         )
 
+        # Skip the playlist if none of its generations files changed since it
+        # was last loaded.
+        sources = [(location, _fingerprint(downloads[location].result()))
+                   for location in playlist_json["locations"]]
+        sources_fingerprint = _sha256(json.dumps(sources))
+        if not full and playlist.sources_fingerprint == sources_fingerprint:
+            print("Generations files of {} are unchanged, skipping.".format(playlist.shortname))
+            continue
+
         gen_count = 0
-        for generation_url in playlist_json["locations"]:
+        generation_ids = set()
+        # Whether a row of any of the playlist's files could not be added.
+        incomplete = False
+        for generation_url, fingerprint in sources:
+            # A file loaded before, for any playlist, yields the same generations.
+            source = None if full else LoadedSource.objects.filter(fingerprint=fingerprint).first()
+            if source is not None:
+                loaded_ids = list(source.generations.values_list("id", flat=True))
+                print("{} is unchanged, reusing its {} generations.".format(
+                    generation_url, len(loaded_ids)))
+                generation_ids.update(loaded_ids)
+                continue
+
             print("Reading in generations from", generation_url)
-            with urllib.request.urlopen(generation_url) as f:
-                generations_json = _read_json(f)
+            generations_json, generations = _read_generations(
+                downloads[generation_url].result())
 
             # Create system if it does not already exist
             desc = "Generated " + generations_json["date-generated"]
@@ -174,53 +449,87 @@ def populate_db(generations_path, version):
                 generations_json["dataset"],
                 generations_json["split"])
 
-            for generation in generations_json["generations"]:
-                # Skip loading the generation if length is less than MIN_LENGTH
-                if len(generation["prompt"]) + \
-                        len(generation["generation"]) < MIN_LENGTH:
-                    continue
-
-                # Truncate the generation so that prompt + generation =
-                # MIN_LENGTH
-                gen_text = generation["generation"][:MIN_LENGTH -
-                                                    len(generation["prompt"])]
-
-                # Create prompt if it does not already exist.
-                prompt = _try_create_prompt(
-                    prompt_id=generation["prompt-index"],
-                    prompt_text=SEP.join(generation["prompt"]),
-                    num_sentences=len(generation["prompt"]),
-                    dataset=dataset)
-
-                # Create deocding strategy if it does not already exist.
-                # TODO(daphne): Add support for others besides top-p.
-                if generation["p"] not in P_VALUES_TO_KEEP:
-                    continue
-
-                decoding_strategy = _try_create_decoding_strategy(
-                    "top-p", generation["p"])
-                try:
-                    generation = _try_create_generation(
-                        prompt=prompt,
-                        system=system,
-                        decoding_strategy=decoding_strategy,
-                        gen_text=SEP.join(generation["generation"]))
-                    playlist.generations.add(generation)
-                    gen_count += 1
-                    if gen_count % 100 == 0:
-                        print("Added {} so far.".format(gen_count))
-                except Exception as e:
-                    print("failure adding generation")
-                    print(e)
+            failed = False
+            if bulk:
+                loaded_ids = _bulk_load_generations(generations, system, dataset, chunk_size)
+                gen_count += len(loaded_ids)
+            else:
+                loaded_ids = []
+                for generation in generations:
+                    # Skip loading the generation if length is less than MIN_LENGTH
+                    if len(generation["prompt"]) + \
+                            len(generation["generation"]) < MIN_LENGTH:
+                        continue
+
+                    # Truncate the generation so that prompt + generation =
+                    # MIN_LENGTH
+                    gen_text = generation["generation"][:MIN_LENGTH -
+                                                        len(generation["prompt"])]
+
+                    # Create prompt if it does not already exist.
+                    prompt = _try_create_prompt(
+                        prompt_id=generation["prompt-index"],
+                        prompt_text=SEP.join(generation["prompt"]),
+                        num_sentences=len(generation["prompt"]),
+                        dataset=dataset)
+
+                    # Create deocding strategy if it does not already exist.
+                    # TODO(daphne): Add support for others besides top-p.
+                    if generation["p"] not in P_VALUES_TO_KEEP:
+                        continue
+
+                    decoding_strategy = _try_create_decoding_strategy(
+                        "top-p", generation["p"])
+                    try:
+                        generation = _try_create_generation(
+                            prompt=prompt,
+                            system=system,
+                            decoding_strategy=decoding_strategy,
+                            gen_text=SEP.join(generation["generation"]))
+                        loaded_ids.append(generation.id)
+                        gen_count += 1
+                        if gen_count % 100 == 0:
+                            print("Added {} so far.".format(gen_count))
+                    except Exception as e:
+                        print("failure adding generation")
+                        print(e)
+                        failed = True
+
+            # A file with failed rows is not recorded as loaded, so the next
+            # run reads it again instead of reusing the partial result.
+            if failed:
+                incomplete = True
+                print("{} was only partially loaded.".format(generation_url))
+            else:
+                _record_source(generation_url, fingerprint, loaded_ids, chunk_size)
+            generation_ids.update(loaded_ids)
         print("Added {} total.".format(gen_count))
 
+        # The playlist holds exactly the generations of its files. If some
+        # could not be added, it keeps the ones it had and is not marked as
+        # up to date, so the next run loads it again.
+        with transaction.atomic():
+            added, removed = _reconcile_playlist(
+                playlist, generation_ids, chunk_size, remove=not incomplete)
+            if not incomplete:
+                playlist.sources_fingerprint = sources_fingerprint
+                playlist.save(update_fields=["sources_fingerprint"])
+        print("{} has {} generations: {} added, {} removed.".format(
+            playlist.shortname, len(generation_ids), added, removed))
+    executor.shutdown()
+
+    feedback.invalidate()
+    playlists.invalidate(version)
+
 
 if __name__ == '__main__':
     # connect to Django runtime
     os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'trick.settings')
     django.setup()
 
-    from django.contrib.auth import get_user_model
-    from core.models import System, Dataset, Prompt, Generation, DecodingStrategy, Playlist, SEP, FeedbackOption
+    from core.models import (
+        System, Dataset, Prompt, Generation, DecodingStrategy, Playlist, SEP, FeedbackOption,
+        LoadedSource)
+    from core import boundaries, feedback, payloads, playlists
 
     populate_db()
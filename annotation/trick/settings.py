@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 """
 
 import os
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -39,7 +40,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'core'
+    'core.apps.CoreConfig'
 ]
 
 MIDDLEWARE = [
@@ -52,6 +53,12 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Report the number of SQL queries each request ran in an X-Query-Count header
+# (used by `manage.py load_test`).
+QUERY_COUNT_HEADER = os.getenv('QUERY_COUNT_HEADER', 'False') == 'True'
+if QUERY_COUNT_HEADER:
+    MIDDLEWARE.insert(0, 'core.middleware.QueryCountMiddleware')
+
 ROOT_URLCONF = 'trick.urls'
 
 TEMPLATES = [
@@ -65,11 +72,34 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'core.profiles.context',
             ],
         },
     },
 ]
 
+# The default cache is shared by every worker process on a host (see core.caching).
+CACHE_PATH = os.getenv('CACHE_PATH', os.path.join(tempfile.gettempdir(), 'roft_cache'))
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': CACHE_PATH,
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    }
+}
+
+# Per-view latency, SQL and template render metrics, aggregated across workers
+# in a local SQLite file and served at /metrics in the Prometheus text format
+# (see core.metrics). Set METRICS_TOKEN to require `Authorization: Bearer <token>`.
+METRICS = os.getenv('METRICS', 'False') == 'True'
+METRICS_PATH = os.getenv('METRICS_PATH', os.path.join(BASE_DIR, 'metrics.sqlite3'))
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+# Requests whose slowest query takes at least this many seconds are logged.
+SLOW_QUERY_SECONDS = float(os.getenv('SLOW_QUERY_SECONDS', '0.1'))
+if METRICS:
+    MIDDLEWARE.insert(0, 'core.middleware.MetricsMiddleware')
+    TEMPLATES[0]['BACKEND'] = 'core.metrics.TimedDjangoTemplates'
+
 WSGI_APPLICATION = 'trick.wsgi.application'
 
 
@@ -98,6 +128,12 @@ else:
         }
     }
 
+# When enabled, annotation submissions are appended to a local journal and
+# written to the database in batches by a background flusher (see core.journal).
+ANNOTATION_WRITE_BEHIND = os.getenv('ANNOTATION_WRITE_BEHIND', 'False') == 'True'
+ANNOTATION_JOURNAL_PATH = os.getenv(
+    'ANNOTATION_JOURNAL_PATH', os.path.join(BASE_DIR, 'annotation_journal.sqlite3'))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
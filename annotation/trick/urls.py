@@ -26,7 +26,10 @@ from core.views import (
     log_out,
     sign_up,
     profile,
-    play
+    play,
+    next_items,
+    submit,
+    metrics
 )
 
 urlpatterns = [
@@ -35,6 +38,9 @@ urlpatterns = [
     path('annotate/', annotate, name="annotate"),
     path('leaderboard/', leaderboard, name="leaderboard"),
     path('save/', save, name="save"),
+    path('api/next/', next_items, name="next_items"),
+    path('api/submit/', submit, name="submit"),
+    path('metrics', metrics, name="metrics"),
     path('login/', log_in, name='log_in'),
     path('join/', join, name='join'),
     path('signup/', sign_up, name='sign_up'),